@@ -0,0 +1,302 @@
+"""Scenario runner.
+
+For every data size it seeds a fresh SQLite database, starts the stub upstreams and drives the
+main pages, logins and comment posts either through the Flask test client (default) or a local
+gunicorn. Reports p50/p95/p99 latency, throughput and queries per request for each scenario.
+
+    python benchmarks/run.py --sizes 100,1000,10000 --requests 200 --concurrency 4
+    python benchmarks/run.py --mode gunicorn --workers 2 --json results.json
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.seed import PASSWORD
+from benchmarks.stubs import StubUpstreams
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class Response:
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+
+class TestClientDriver:
+    def __init__(self, app):
+        self.app = app
+
+    def client(self):
+        return FlaskClient(self.app.test_client())
+
+
+class FlaskClient:
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, path):
+        response = self._client.get(path)
+        return Response(response.status_code, response.headers, response.get_data(as_text=True))
+
+    def post(self, path, data):
+        response = self._client.post(path, data=data)
+        return Response(response.status_code, response.headers, response.get_data(as_text=True))
+
+
+class HttpDriver:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def client(self):
+        return HttpClient(self.base_url)
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self._session = requests.Session()
+
+    def get(self, path):
+        response = self._session.get(self.base_url + path, allow_redirects=False)
+        return Response(response.status_code, response.headers, response.text)
+
+    def post(self, path, data):
+        response = self._session.post(self.base_url + path, data=data, allow_redirects=False)
+        return Response(response.status_code, response.headers, response.text)
+
+
+def csrf_token(client, path):
+    match = CSRF_PATTERN.search(client.get(path).text)
+    if match is None:
+        raise RuntimeError(f"No CSRF token on {path}")
+    return match.group(1)
+
+
+def log_in(client, data):
+    if getattr(client, "logged_in", False):
+        return
+    email = f"bench{data['users'][0]}@example.com"
+    response = client.post("/login", {"email": email, "password": PASSWORD, "csrf_token": csrf_token(client, "/login")})
+    if response.status != 302:
+        raise RuntimeError(f"Login as {email} failed with {response.status}")
+    client.logged_in = True
+
+
+# Scenarios - do any unmeasured setup, then return (request to time, expected status)
+def home(client, data, rng):
+    return lambda: client.get("/"), 200
+
+
+def post_page(client, data, rng):
+    post_id = rng.randint(*data["posts"])
+    return lambda: client.get(f"/posts/{post_id}"), 200
+
+
+def profile(client, data, rng):
+    user_id = rng.randint(*data["users"])
+    return lambda: client.get(f"/profile/{user_id}"), 200
+
+
+def login(client, data, rng):
+    user_id = rng.randint(*data["users"])
+    form = {"email": f"bench{user_id}@example.com", "password": PASSWORD, "csrf_token": csrf_token(client, "/login")}
+    return lambda: client.post("/login", form), 302
+
+
+def comment(client, data, rng):
+    log_in(client, data)
+    if not hasattr(client, "token"):
+        client.token = csrf_token(client, f"/posts/{data['posts'][0]}")
+    post_id = rng.randint(*data["posts"])
+    form = {"comment": f"<p>Benchmark comment {rng.random()}</p>", "csrf_token": client.token}
+    return lambda: client.post(f"/posts/{post_id}", form), 302
+
+
+SCENARIOS = {
+    "home": home,
+    "post": post_page,
+    "profile": profile,
+    "login": login,
+    "comment": comment,
+}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def run_scenario(driver, scenario, data, requests, warmup, concurrency, random_seed=0):
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(worker_id, count):
+        rng = random.Random(random_seed * 1000 + worker_id)
+        client = driver.client()
+        for i in range(warmup + count):
+            call, expected = scenario(client, data, rng)
+            started = time.perf_counter()
+            response = call()
+            elapsed = time.perf_counter() - started
+            if i < warmup:
+                continue
+            with lock:
+                latencies.append(elapsed)
+                if "X-Query-Count" in response.headers:
+                    queries.append(int(response.headers["X-Query-Count"]))
+                if response.status != expected:
+                    errors.append(response.status)
+
+    # Split the requests between the workers, the first ones take the remainder
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, i, share) for i, share in enumerate(shares)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rps": len(latencies) / wall if wall else 0.0,
+        "queries": statistics.mean(queries) if queries else None,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(env, workers):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "server:create_app()", "-b", f"127.0.0.1:{port}", "-w", str(workers),
+         "--worker-class", "gthread", "--threads", "4"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    client = HttpClient(base_url)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if client.get("/about").status == 200:
+                return process, base_url
+        except OSError:
+            pass
+        if process.poll() is not None:
+            break
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not come up")
+
+
+def seed_database(env, posts, comments):
+    # Separate process so seeding doesn't warm this one up - ids start at 1 in the fresh database
+    users = max(posts // 10, 10)
+    output = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "seed.py"),
+         "--users", str(users), "--posts", str(posts), "--comments", str(comments)],
+        cwd=ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    print(output.strip().splitlines()[-1])
+    return {"users": (1, users), "posts": (1, posts)}
+
+
+def print_table(size, results):
+    print(f"\n{size} posts")
+    print(f"{'scenario':<10}{'requests':>9}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'queries':>9}")
+    for name, result in results.items():
+        queries = "-" if result["queries"] is None else f"{result['queries']:.1f}"
+        print(f"{name:<10}{result['requests']:>9}{result['errors']:>7}{result['p50_ms']:>9.1f}"
+              f"{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['rps']:>9.1f}{queries:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the benchmark scenarios at several data sizes")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated post counts")
+    parser.add_argument("--comments", type=int, default=5, help="comments per post")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per worker")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mode", choices=["testclient", "gunicorn"], default="testclient")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--upstream-latency", type=float, default=0.0, help="seconds added by the stub APIs")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    stubs = StubUpstreams(latency=args.upstream_latency).start()
+    env = dict(os.environ)
+    env.update(stubs.env())
+    # Every simulated client shares 127.0.0.1 - rate limits would measure the limiter, not the app
+    env.update({"QUERY_COUNT_HEADER": "1", "REDIS_URL": "", "REQUEST_LOG": "0", "RATE_LIMIT_ENABLED": "0"})
+    env.setdefault("WTF_CSRF_SECRET_KEY", "benchmark")
+    env.setdefault("APP_SECRET_KEY", "benchmark")
+    # The test client runs in this process - news_weather reads the stub endpoints on import
+    os.environ.update(env)
+
+    all_results = {}
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            with tempfile.TemporaryDirectory() as tmp:
+                env["DB_URI"] = os.environ["DB_URI"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+                data = seed_database(env, size, args.comments)
+
+                process = app = None
+                if args.mode == "gunicorn":
+                    process, base_url = start_gunicorn(env, args.workers)
+                    driver = HttpDriver(base_url)
+                else:
+                    import server
+                    # Every app has its own caches - each size starts cold
+                    app = server.create_app()
+                    driver = TestClientDriver(app)
+
+                try:
+                    results = {
+                        name: run_scenario(driver, SCENARIOS[name], data, args.requests, args.warmup, args.concurrency)
+                        for name in args.scenarios.split(",")
+                    }
+                finally:
+                    if process is not None:
+                        process.terminate()
+                        process.wait()
+                    if app is not None:
+                        app.extensions["refresher"].stop()
+                        app.extensions["mail_worker"].stop()
+                print_table(size, results)
+                all_results[size] = results
+    finally:
+        stubs.stop()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"mode": args.mode, "concurrency": args.concurrency, "results": all_results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Synthetic data for benchmarks.
+
+Bulk inserts users, posts and comments with body sizes close to real CKEditor content, then
+builds the search index for them. Output is the same for the same --random-seed. Every seeded
+user can log in with the password in PASSWORD.
+
+    DB_URI=sqlite:////tmp/bench.db python benchmarks/seed.py --users 100 --posts 1000 --comments 5
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert
+from werkzeug.security import generate_password_hash
+
+from database import db, User, BlogPosts, Comment
+import content
+
+PASSWORD = "benchmark-password"
+BATCH_SIZE = 1000
+WORDS = (
+    "the a to of and in is it that for on was with as be this have from at by not but are or had "
+    "blog post weather news city coffee travel garden recipe morning story photo river mountain "
+    "project python flask database server cache request page reader writer week summer winter "
+    "market music friend family weekend evening book train road light color idea plan review"
+).split()
+
+
+def sentence(rng, min_words=6, max_words=18) -> str:
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def paragraph(rng, min_sentences=3, max_sentences=7) -> str:
+    return " ".join(sentence(rng) for _ in range(rng.randint(min_sentences, max_sentences)))
+
+
+def post_body(rng) -> str:
+    # Most posts are a few paragraphs, a long tail runs to 20+ (roughly 1-15 KB of HTML)
+    paragraphs = min(int(rng.lognormvariate(1.6, 0.6)) + 1, 30)
+    return "".join(f"<p>{paragraph(rng)}</p>" for _ in range(paragraphs))
+
+
+def comment_body(rng) -> str:
+    return f"<p>{paragraph(rng, 1, 3)}</p>"
+
+
+def _next_id(model) -> int:
+    return (db.session.execute(db.select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(model), rows[start:start + BATCH_SIZE])
+
+
+def seed(users=100, posts=1000, comments_per_post=5, random_seed=0) -> dict:
+    """Insert the rows in the current app context, returns the id ranges that were used."""
+    rng = random.Random(random_seed)
+    # One hash for everybody - hashing thousands of scrypt passwords would dominate seeding
+    password = generate_password_hash(
+        PASSWORD,
+        method=os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1"),
+        salt_length=int(os.environ.get("PASSWORD_SALT_LENGTH", 16))
+    )
+
+    first_user = _next_id(User)
+    user_rows = []
+    for user_id in range(first_user, first_user + users):
+        email = f"bench{user_id}@example.com"
+        email_hash = hashlib.sha256(email.encode()).hexdigest()
+        user_rows.append({
+            "id": user_id,
+            "email": email,
+            "email_hash": email_hash,
+            "password": password,
+            "username": f"bench{user_id}",
+            "profile_pic": f"https://gravatar.com/avatar/{email_hash}?d=retro&s=40",
+            "user_bio": sentence(rng),
+            "post_count": 0,
+        })
+    user_ids = [row["id"] for row in user_rows]
+    users_by_id = {row["id"]: row for row in user_rows}
+
+    first_post = _next_id(BlogPosts)
+    now = datetime.now()
+    post_rows = []
+    for post_id in range(first_post, first_post + posts):
+        # Spread over two years, in id order like real posts
+        created_at = now - timedelta(days=730) * (first_post + posts - post_id) / posts
+        author_id = rng.choice(user_ids)
+        users_by_id[author_id]["post_count"] += 1
+        body = post_body(rng)
+        post_rows.append({
+            "id": post_id,
+            "author_id": author_id,
+            # Titles are unique in the schema - the id keeps them apart at any size
+            "title": f"{sentence(rng, 3, 8)[:-1]} {post_id}",
+            "subtitle": sentence(rng, 5, 12)[:-1],
+            "date": created_at.strftime("%B %w, %Y"),
+            "created_at": created_at,
+            "body": body,
+            "img_url": f"https://picsum.photos/seed/{post_id}/1200/600",
+            "comment_count": comments_per_post,
+            **vars(content.render_post(body)),
+        })
+    # Counters and rendered HTML are filled in here, the rows bypass the routes that maintain them
+    _insert(User, user_rows)
+    _insert(BlogPosts, post_rows)
+
+    first_comment = _next_id(Comment)
+    comment_rows = []
+    for post in post_rows:
+        for _ in range(comments_per_post):
+            body = comment_body(rng)
+            comment_rows.append({
+                "id": first_comment + len(comment_rows),
+                "author_id": rng.choice(user_ids),
+                "post_id": post["id"],
+                "comment_body": body,
+                "body_html": content.sanitize_comment(body),
+            })
+    _insert(Comment, comment_rows)
+    db.session.commit()
+
+    return {
+        "users": (first_user, first_user + users - 1),
+        "posts": (first_post, first_post + posts - 1),
+        "comments": (first_comment, first_comment + len(comment_rows) - 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk insert synthetic users, posts and comments")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=5, help="comments per post")
+    parser.add_argument("--random-seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    import search
+    from server import create_app
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        ranges = seed(args.users, args.posts, args.comments, args.random_seed)
+        with db.engine.begin() as conn:
+            search.rebuild(app.extensions["search_index"], conn)
+        print(f"Seeded {ranges} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Startup time and memory of the app.
+
+Imports server and builds the app in a fresh interpreter, then reports how long each step took
+and the resident memory afterwards. Exits non-zero when a limit is passed so it can guard CI:
+
+    python benchmarks/startup.py --max-import-seconds 1.5 --max-rss-mb 120
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter - prints one JSON line
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+app = server.create_app()
+created = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = sorted(name for name in ("pandas", "numpy", "selenium", "twilio", "geopy", "geocoder", "bs4")
+               if name in sys.modules)
+print(json.dumps({
+    "import_seconds": imported - start,
+    "create_app_seconds": created - imported,
+    "max_rss_mb": rss_kb / 1024,
+    "modules": len(sys.modules),
+    "heavy_modules": heavy,
+}))
+"""
+
+
+def measure(env) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-seconds", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ)
+    # Never touch a real database - the app is only built, not served
+    env.setdefault("DB_URI", "sqlite://")
+    env.setdefault("WTF_CSRF_SECRET_KEY", "benchmark")
+    env.setdefault("APP_SECRET_KEY", "benchmark")
+
+    runs = [measure(env) for _ in range(args.runs)]
+    import_seconds = sorted(run["import_seconds"] for run in runs)[len(runs) // 2]
+    create_app_seconds = sorted(run["create_app_seconds"] for run in runs)[len(runs) // 2]
+    rss_mb = max(run["max_rss_mb"] for run in runs)
+
+    print(f"import server   {import_seconds * 1000:8.1f} ms (median of {args.runs})")
+    print(f"create_app()    {create_app_seconds * 1000:8.1f} ms")
+    print(f"max RSS         {rss_mb:8.1f} MB")
+    print(f"modules loaded  {runs[-1]['modules']:8d}")
+    if runs[-1]["heavy_modules"]:
+        print(f"heavy modules   {', '.join(runs[-1]['heavy_modules'])}")
+
+    failed = False
+    if args.max_import_seconds is not None and import_seconds > args.max_import_seconds:
+        print(f"FAIL: import took longer than {args.max_import_seconds}s")
+        failed = True
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        print(f"FAIL: RSS above {args.max_rss_mb} MB")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Local stand-ins for the news, weather, IP and Nominatim APIs.
+
+The refresher talks to these instead of the real services so benchmark numbers don't depend on
+the network. Point the app at them with the environment from StubUpstreams.env(), or run this
+file to keep them up while testing by hand:
+
+    python benchmarks/stubs.py --port 8089
+"""
+from __future__ import annotations
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+CITY = {"city": "Springfield", "state": "IL", "lat": 39.7817, "lng": -89.6501}
+
+
+def news_articles(count=10):
+    return [
+        {
+            "source": {"id": None, "name": "Stub News"},
+            "title": f"Stub headline number {i}",
+            "description": "A short summary of a story that did not really happen. " * 3,
+            "url": f"https://example.com/news/{i}",
+            "urlToImage": f"https://example.com/news/{i}.jpg",
+            "publishedAt": "2024-01-01T12:00:00Z",
+        }
+        for i in range(count)
+    ]
+
+
+def forecast_periods(count=14):
+    return [
+        {
+            "number": i + 1,
+            "name": "Tonight" if i % 2 else "Today",
+            "temperature": 60 + i,
+            "temperatureUnit": "F",
+            "icon": "https://api.weather.gov/icons/land/day/few?size=medium",
+            "shortForecast": "Sunny",
+            "detailedForecast": "Sunny, with a high near 70. Light wind.",
+        }
+        for i in range(count)
+    ]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set by StubUpstreams - seconds to sleep before every answer
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        path = urlsplit(self.path).path
+        base = f"http://{self.headers['Host']}"
+        if path == "/v2/top-headlines":
+            articles = news_articles()
+            return self._json({"status": "ok", "totalResults": len(articles), "articles": articles})
+        if path == "/json":
+            return self._json({"ip": "127.0.0.1", "city": CITY["city"], "loc": f"{CITY['lat']},{CITY['lng']}"})
+        if path == "/search":
+            return self._json([{
+                "place_id": 1,
+                "lat": str(CITY["lat"]),
+                "lon": str(CITY["lng"]),
+                "display_name": f"{CITY['city']}, {CITY['state']}, United States",
+            }])
+        if re.fullmatch(r"/points/[-0-9.]+,[-0-9.]+", path):
+            return self._json({"properties": {
+                "forecast": f"{base}/gridpoints/ILX/50,60/forecast",
+                "relativeLocation": {"properties": {"city": CITY["city"], "state": CITY["state"]}},
+            }})
+        if re.fullmatch(r"/gridpoints/\w+/\d+,\d+/forecast", path):
+            return self._json({"properties": {"periods": forecast_periods()}})
+        self._json({"error": f"no stub for {path}"}, status=404)
+
+
+class StubUpstreams:
+    """Serves every stubbed API from one local port on a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        handler = type("Handler", (StubHandler,), {"latency": latency})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> dict:
+        # Environment for news_weather - must be set before it is imported
+        host, port = self.server.server_address[:2]
+        return {
+            "NEWS_ENDPOINT": f"{self.url}/v2/top-headlines",
+            "NEWS_API_KEY": "benchmark",
+            "WEATHER_POINTS_ENDPOINT": f"{self.url}/points",
+            "IP_GEOCODE_ENDPOINT": self.url,
+            "NOMINATIM_DOMAIN": f"{host}:{port}",
+            "NOMINATIM_SCHEME": "http",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-upstreams", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stub upstream APIs")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    stubs = StubUpstreams(port=args.port, latency=args.latency)
+    for name, value in stubs.env().items():
+        print(f"export {name}={value}")
+    stubs.server.serve_forever()
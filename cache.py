@@ -0,0 +1,112 @@
+"""TTL caches shared by the app.
+
+LocalCache lives in a single process, RedisCache is shared by every gunicorn worker.
+Both take JSON friendly values so either one can be swapped in with make_cache().
+"""
+from __future__ import annotations
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCache:
+    """In-process TTL cache with LRU eviction once max_entries is reached."""
+
+    def __init__(self, max_entries: int = 1024, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        # key -> (expires_at or None, value)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, expires_at) -> bool:
+        return expires_at is not None and expires_at <= self.clock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if self._expired(entry[0]):
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def get_many(self, keys) -> list:
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value, ttl: float | None = None):
+        expires_at = self.clock() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        # Only set the key if it is missing - used as a lock between refreshers
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                return False
+        self.set(key, value, ttl)
+        return True
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Redis backed TTL cache - values are stored as JSON under a common prefix."""
+
+    def __init__(self, url: str, prefix: str = "bloggin:", client=None):
+        if client is None:
+            # Only pull redis in when a Redis cache is actually configured
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def get(self, key: str, default=None):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def get_many(self, keys) -> list:
+        keys = list(keys)
+        if not keys:
+            return []
+        return [None if raw is None else json.loads(raw) for raw in self.client.mget([self._key(key) for key in keys])]
+
+    def set(self, key: str, value, ttl: float | None = None):
+        self.client.set(self._key(key), json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key: str, value, ttl: float | None = None) -> bool:
+        return bool(self.client.set(self._key(key), json.dumps(value), px=int(ttl * 1000) if ttl else None, nx=True))
+
+    def delete(self, *keys: str):
+        if keys:
+            self.client.delete(*(self._key(key) for key in keys))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=f"{self.prefix}*"):
+            self.client.delete(key)
+
+
+def make_cache(url: str | None = None, prefix: str = "bloggin:", **local_options):
+    # Use Redis when a redis:// url is configured, otherwise fall back to a per-process cache
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url, prefix=prefix)
+    return LocalCache(**local_options)
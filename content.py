@@ -0,0 +1,181 @@
+"""Write-time processing of CKEditor HTML.
+
+Post bodies and comments are sanitized once when they are saved, the cleaned HTML goes in
+body_html next to the raw editor source. Posts also get a plain-text excerpt for listings, a
+reading time and the list of outbound image URLs, so pages only ever output stored values.
+backfill() renders rows written before this existed (`flask render-content`).
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from functools import cache
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+from sqlalchemy import bindparam, select, update
+
+from database import BlogPosts, Comment
+
+EXCERPT_LENGTH = 200
+WORDS_PER_MINUTE = 200
+BATCH_SIZE = 500
+
+# What CKEditor's toolbar can produce - everything else is stripped, keeping the text
+POST_TAGS = frozenset({
+    "a", "abbr", "b", "blockquote", "br", "code", "del", "div", "em", "figcaption", "figure",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "i", "img", "li", "ol", "p", "pre", "s", "span",
+    "strong", "sub", "sup", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "u", "ul",
+})
+COMMENT_TAGS = frozenset({
+    "a", "b", "blockquote", "br", "code", "em", "i", "li", "ol", "p", "pre", "s", "strong", "u", "ul",
+})
+ATTRIBUTES = {
+    "a": ["href", "title"],
+    "abbr": ["title"],
+    "img": ["src", "alt", "title", "width", "height"],
+    "td": ["colspan", "rowspan"],
+    "th": ["colspan", "rowspan", "scope"],
+}
+PROTOCOLS = frozenset({"http", "https", "mailto"})
+# Removed together with their contents - stripping only the tags would leave code as visible text
+DROPPED_TAGS = frozenset({"script", "style"})
+
+
+@dataclass
+class RenderedPost:
+    body_html: str
+    excerpt: str
+    reading_minutes: int
+    image_urls: list[str] = field(default_factory=list)
+
+
+class _TextAndImages(HTMLParser):
+    # One pass over the cleaned HTML for the plain text and the <img> sources
+    def __init__(self):
+        super().__init__()
+        self.text = []
+        self.images = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "img":
+            src = dict(attrs).get("src")
+            if src and urlsplit(src).scheme in ("http", "https") and src not in self.images:
+                self.images.append(src)
+        elif tag in ("br", "p", "li", "div", "td", "th"):
+            self.text.append(" ")
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+
+def _drop_elements(tokens, names):
+    # Skip the tokens from <name> to its </name>, html5lib tree walkers always close what they open
+    depth = 0
+    for token in tokens:
+        if token["type"] in ("StartTag", "EndTag") and token["name"] in names:
+            depth += 1 if token["type"] == "StartTag" else -1
+        elif not depth:
+            yield token
+
+
+@cache
+def _cleaner(tags: frozenset):
+    # bleach pulls in html5lib - only needed once something is written
+    import bleach
+    from bleach.html5lib_shim import BleachHTMLParser
+    cleaner = bleach.Cleaner(tags=tags, attributes=ATTRIBUTES, protocols=PROTOCOLS, strip=True)
+    # bleach's parser already turns disallowed tags into text, so let it keep <script> and <style>
+    # as elements for the walker to drop whole. The sanitizer still strips any that get through
+    cleaner.parser = BleachHTMLParser(
+        tags=tags | DROPPED_TAGS, strip=True, consume_entities=False, namespaceHTMLElements=False
+    )
+    walker = cleaner.walker
+    cleaner.walker = lambda dom: _drop_elements(walker(dom), DROPPED_TAGS)
+    return cleaner
+
+
+def sanitize_post(html: str | None) -> str:
+    return _cleaner(POST_TAGS).clean(html or "")
+
+
+def sanitize_comment(html: str | None) -> str:
+    return _cleaner(COMMENT_TAGS).clean(html or "")
+
+
+def excerpt(text: str, length: int = EXCERPT_LENGTH) -> str:
+    if len(text) <= length:
+        return text
+    # Cut on a word boundary, one character of lookahead keeps a word that ends exactly at length
+    cut = text[:length + 1]
+    cut = cut.rsplit(" ", 1)[0] if " " in cut else cut[:length]
+    return cut.rstrip(" ,.;:-") + "…"
+
+
+def render_post(html: str | None) -> RenderedPost:
+    body_html = sanitize_post(html)
+    parser = _TextAndImages()
+    parser.feed(body_html)
+    parser.close()
+    text = " ".join("".join(parser.text).split())
+    words = len(text.split())
+    return RenderedPost(
+        body_html=body_html,
+        excerpt=excerpt(text),
+        reading_minutes=max(1, round(words / WORDS_PER_MINUTE)),
+        image_urls=parser.images,
+    )
+
+
+def apply_post(post):
+    # Call whenever post.body changes, before the commit
+    rendered = render_post(post.body)
+    post.body_html = rendered.body_html
+    post.excerpt = rendered.excerpt
+    post.reading_minutes = rendered.reading_minutes
+    post.image_urls = rendered.image_urls
+
+
+def apply_comment(comment):
+    comment.body_html = sanitize_comment(comment.comment_body)
+
+
+def _batches(conn, id_column, columns, only_missing):
+    # Keyset over the primary key, never holds more than one batch of bodies
+    last_id = 0
+    while True:
+        query = select(id_column, *columns).where(id_column > last_id).order_by(id_column).limit(BATCH_SIZE)
+        if only_missing is not None:
+            query = query.where(only_missing.is_(None))
+        rows = conn.execute(query).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def backfill(conn, everything: bool = False) -> dict:
+    """Render posts and comments that have no body_html yet (or all of them), returns the counts."""
+    posts, comments = BlogPosts.__table__, Comment.__table__
+    post_update = update(posts).where(posts.c.id == bindparam("row_id")).values(
+        body_html=bindparam("body_html"),
+        excerpt=bindparam("excerpt"),
+        reading_minutes=bindparam("reading_minutes"),
+        image_urls=bindparam("image_urls"),
+    )
+    comment_update = update(comments).where(comments.c.id == bindparam("row_id")).values(
+        body_html=bindparam("body_html")
+    )
+
+    counts = {"posts": 0, "comments": 0}
+    missing = None if everything else posts.c.body_html
+    for rows in _batches(conn, posts.c.id, [posts.c.body], missing):
+        conn.execute(post_update, [
+            {"row_id": post_id, **vars(render_post(body))} for post_id, body in rows
+        ])
+        counts["posts"] += len(rows)
+    missing = None if everything else comments.c.body_html
+    for rows in _batches(conn, comments.c.id, [comments.c.comment_body], missing):
+        conn.execute(comment_update, [
+            {"row_id": comment_id, "body_html": sanitize_comment(body)} for comment_id, body in rows
+        ])
+        counts["comments"] += len(rows)
+    return counts
@@ -0,0 +1,41 @@
+"""Denormalized post and comment counts.
+
+User.post_count and BlogPosts.comment_count are bumped with a single UPDATE ... SET n = n + 1 in
+the same transaction as the insert or delete they count, so they can't drift on concurrent
+writes. repair() recomputes both from the real rows (`flask repair-counts`).
+Takes anything with .execute() - db.session in routes, a Connection in migrations.
+"""
+from __future__ import annotations
+
+from sqlalchemy import func, select, update
+
+from database import User, BlogPosts, Comment
+
+
+def change_post_count(conn, user_id: int, delta: int):
+    conn.execute(update(User).where(User.id == user_id).values(post_count=User.post_count + delta))
+
+
+def change_comment_count(conn, post_id: int, delta: int):
+    conn.execute(
+        update(BlogPosts).where(BlogPosts.id == post_id).values(comment_count=BlogPosts.comment_count + delta)
+    )
+
+
+def repair(conn) -> dict:
+    """Recompute every counter in bulk, returns how many rows were wrong."""
+    post_counts = (
+        select(func.count(BlogPosts.id)).where(BlogPosts.author_id == User.id).scalar_subquery()
+    )
+    comment_counts = (
+        select(func.count(Comment.id)).where(Comment.post_id == BlogPosts.id).scalar_subquery()
+    )
+    users = conn.execute(
+        update(User).where(User.post_count != post_counts).values(post_count=post_counts)
+        .execution_options(synchronize_session=False)
+    )
+    posts = conn.execute(
+        update(BlogPosts).where(BlogPosts.comment_count != comment_counts).values(comment_count=comment_counts)
+        .execution_options(synchronize_session=False)
+    )
+    return {"users": users.rowcount, "posts": posts.rowcount}
@@ -1,14 +1,163 @@
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Integer, String, Float, exc, ForeignKey
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Integer, String, Float, DateTime, JSON, exc, ForeignKey, Index, Select, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy.pool import QueuePool
 from flask_login import UserMixin
 
+# Engine settings - app.config keys and their defaults, see configure_engines()
+ENGINE_DEFAULTS = {
+    "DB_POOL_SIZE": 5,
+    "DB_MAX_OVERFLOW": 10,
+    "DB_POOL_TIMEOUT": 30,
+    # Postgres closes idle connections on some hosts - recycle before that happens
+    "DB_POOL_RECYCLE": 1800,
+    "DB_POOL_PRE_PING": True,
+    "DB_STATEMENT_TIMEOUT_MS": None,
+    "SQLITE_BUSY_TIMEOUT_MS": 5000,
+    "SQLITE_MMAP_SIZE": 256 * 1024 * 1024,
+    "DB_REPLICA_URI": None,
+    # After a write the same visitor reads from the primary for this long, replicas may lag
+    "DB_REPLICA_PIN_SECONDS": 5,
+}
+REPLICA_BIND = "replica"
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection."""
+
+    # Called with the wait in seconds
+    on_wait = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        connection = super()._do_get()
+        if self.on_wait is not None:
+            self.on_wait(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.on_wait = self.on_wait
+        return pool
+
+
+def is_sqlite_memory(url) -> bool:
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def engine_options(url, config) -> dict:
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        if is_sqlite_memory(url):
+            return {}
+        # The busy timeout is set again as a pragma, this covers the very first connect
+        return {
+            "poolclass": MeteredQueuePool,
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_MAX_OVERFLOW"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+            "connect_args": {"timeout": config["SQLITE_BUSY_TIMEOUT_MS"] / 1000},
+        }
+    options = {
+        "poolclass": MeteredQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    if backend == "postgresql" and config["DB_STATEMENT_TIMEOUT_MS"]:
+        options["connect_args"] = {"options": f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT_MS'])}"}
+    return options
+
+
+def sqlite_pragmas(config):
+    def set_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers carry on while a comment is being written
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute(f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}")
+        cursor.close()
+    return set_pragmas
+
+
+def configure_engines(app):
+    """Fill SQLALCHEMY_ENGINE_OPTIONS and the replica bind from the DB_* settings.
+
+    Call before db.init_app(app), then setup_engines(app) once the engines exist.
+    """
+    for key, value in ENGINE_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.config.setdefault(
+        "SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config["SQLALCHEMY_DATABASE_URI"], app.config)
+    )
+    replica_uri = app.config["DB_REPLICA_URI"]
+    if replica_uri:
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds[REPLICA_BIND] = {"url": replica_uri, **engine_options(replica_uri, app.config)}
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+
+def setup_engines(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite" and not is_sqlite_memory(engine.url):
+                event.listen(engine, "connect", sqlite_pragmas(app.config))
+
+
+class RoutingSession(Session):
+    """Sends SELECTs to the replica bind during requests marked with @read_replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and isinstance(clause, Select)
+            and has_request_context()
+            and g.get("read_replica")
+        ):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _pin_to_primary(db_session, flush_context):
+    # Read your own writes - keep this visitor on the primary until the replica has caught up
+    if has_request_context() and REPLICA_BIND in db_session._db.engines:
+        session["primary_until"] = time.time() + current_app.config["DB_REPLICA_PIN_SECONDS"]
+
+
+def read_replica(view):
+    """Serve the GETs of a read-only route from the replica bind when one is configured."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = (
+            request.method in ("GET", "HEAD")
+            and REPLICA_BIND in db.engines
+            and session.get("primary_until", 0) < time.time()
+        )
+        return view(*args, **kwargs)
+    return wrapper
+
+
 # DB classes
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 class User(db.Model, UserMixin):
     __tablename__ = "users"
@@ -20,6 +169,8 @@ class User(db.Model, UserMixin):
     username: Mapped[str] = mapped_column(String(30), unique=True, nullable=False)
     profile_pic: Mapped[str] = mapped_column(String[255], nullable=True)
     user_bio: Mapped[str] = mapped_column(String[255], nullable=True)
+    # Maintained by counters.py in the same transaction as the posts themselves
+    post_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
     # This will act like a List of BlogPost objects attached to each User.
     # Every User class will have a posts list
     posts = relationship("BlogPosts", back_populates="author")
@@ -32,21 +183,55 @@ class BlogPosts(db.Model):
     # Create Foreign Key, user.id that refers to User table - ties the value of author_id to the User.id
     author_id: Mapped[int] = mapped_column(Integer, ForeignKey(column="users.id"))
     title: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+    # Display date - created_at is the sortable/queryable version
     date: Mapped[str] = mapped_column(String(255), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now, index=True)
     body: Mapped[str] = mapped_column(String, nullable=False)
     img_url: Mapped[str] = mapped_column(String(255), nullable=False)
     subtitle: Mapped[str] = mapped_column(String(255), nullable=False)
+    # Written by content.apply_post() whenever body changes - pages output these, never body
+    body_html: Mapped[str] = mapped_column(String, nullable=True)
+    excerpt: Mapped[str] = mapped_column(String(255), nullable=True)
+    reading_minutes: Mapped[int] = mapped_column(Integer, nullable=True)
+    image_urls: Mapped[list] = mapped_column(JSON, nullable=True)
+    # Maintained by counters.py in the same transaction as the comments themselves
+    comment_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
     # Create ref to the User object. the posts refers to the posts property of User class
-    author = relationship("User", back_populates="posts")
-    # Holds all comments for this post
-    post_comments = relationship("Comment", back_populates="parent_post")
+    # Every page showing a post shows its author - load them in the same query
+    author = relationship("User", back_populates="posts", lazy="joined")
+    # Holds all comments for this post - routes that show comments ask for them with selectinload
+    post_comments = relationship("Comment", back_populates="parent_post", order_by="Comment.id")
+
+    # Per-author listings newest first - also serves plain author_id lookups
+    __table_args__ = (Index("ix_blog_posts_author_id_created_at", "author_id", "created_at"),)
 
 class Comment(db.Model):
     __tablename__ = "comments"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    author_id: Mapped[int] = mapped_column(Integer, ForeignKey(column="users.id"))
-    post_id: Mapped[int] = mapped_column(Integer, ForeignKey("blog_posts.id"))
+    author_id: Mapped[int] = mapped_column(Integer, ForeignKey(column="users.id"), index=True)
+    post_id: Mapped[int] = mapped_column(Integer, ForeignKey("blog_posts.id"), index=True)
     comment_body: Mapped[str] = mapped_column(String, nullable=False)
-    author = relationship("User", back_populates="comments")
+    # Sanitized comment_body from content.apply_comment()
+    body_html: Mapped[str] = mapped_column(String, nullable=True)
+    author = relationship("User", back_populates="comments", lazy="joined")
     parent_post = relationship("BlogPosts", back_populates="post_comments")
+
+class OutboxMessage(db.Model):
+    # Contact form emails waiting for the mail worker
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    to_addr: Mapped[str] = mapped_column(String(255), nullable=False)
+    subject: Mapped[str] = mapped_column(String(255), nullable=False)
+    body: Mapped[str] = mapped_column(String, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # Unsent messages are picked up once next_attempt_at has passed
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    # Set while a worker is sending so other gunicorn workers skip the row
+    locked_until: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    sent_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str] = mapped_column(String, nullable=True)
+
+    __table_args__ = (Index("ix_outbox_sent_at_next_attempt_at", "sent_at", "next_attempt_at"),)
@@ -0,0 +1,47 @@
+"""Atom and JSON Feed documents for the latest posts, site wide or per author.
+
+The feed views are page cached for everybody with an ETag, so polling readers get a 304 or a
+stored copy. A feed is only rebuilt when new_post/edit_post/delete_post invalidate one of the
+tags it was built from (posts, profile:<id>, post:<id>, user:<id>).
+"""
+from __future__ import annotations
+from datetime import datetime
+
+from flask import url_for
+
+JSON_FEED_VERSION = "https://jsonfeed.org/version/1.1"
+
+
+def timestamp(value: datetime) -> str:
+    # RFC 3339 - created_at is naive local time
+    return value.astimezone().isoformat(timespec="seconds")
+
+
+def updated(posts) -> str:
+    return timestamp(max((post.created_at for post in posts), default=datetime.now()))
+
+
+def json_feed(title: str, home_page_url: str, feed_url: str, posts) -> dict:
+    items = []
+    for post in posts:
+        url = url_for("blog.get_blog_post", post_id=post.id, _external=True)
+        items.append({
+            "id": url,
+            "url": url,
+            "title": post.title,
+            "summary": post.excerpt,
+            "content_html": post.body_html,
+            "image": post.img_url,
+            "date_published": timestamp(post.created_at),
+            "authors": [{
+                "name": post.author.username,
+                "url": url_for("blog.get_profile", user_id=post.author_id, _external=True),
+            }],
+        })
+    return {
+        "version": JSON_FEED_VERSION,
+        "title": title,
+        "home_page_url": home_page_url,
+        "feed_url": feed_url,
+        "items": items,
+    }
@@ -0,0 +1,103 @@
+"""Persistent geocoding cache.
+
+Maps a normalized location string to its coordinates and weather.gov forecast url so a repeat
+lookup skips both the Nominatim and the weather.gov /points/ calls. Lives in its own SQLite
+file next to posts.db and survives restarts, least recently used entries are evicted. Locations
+that couldn't be found are remembered for a shorter miss_ttl so they aren't looked up again.
+"""
+from __future__ import annotations
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class GeocodeCache:
+    def __init__(self, path: str, max_entries: int = 5000, ttl: float = 30 * 24 * 3600, miss_ttl: float = 24 * 3600,
+                 clock=time.time):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocodes ("
+                "location TEXT PRIMARY KEY, "
+                "lat REAL NOT NULL, "
+                "lng REAL NOT NULL, "
+                "forecast_url TEXT, "
+                "city TEXT, "
+                "state TEXT, "
+                "created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_geocodes_last_used ON geocodes (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS misses (location TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        # Short lived connections - the refresher and request threads both use the cache
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, location: str) -> dict | None:
+        now = self.clock()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT lat, lng, forecast_url, city, state FROM geocodes WHERE location = ? AND created_at > ?",
+                (location, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE geocodes SET last_used = ? WHERE location = ?", (now, location))
+        lat, lng, forecast_url, city, state = row
+        return {"lat": lat, "lng": lng, "forecast_url": forecast_url, "city": city, "state": state}
+
+    def set(self, location: str, point: dict):
+        now = self.clock()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO geocodes (location, lat, lng, forecast_url, city, state, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (location, point["lat"], point["lng"], point.get("forecast_url"), point.get("city"),
+                 point.get("state"), now, now)
+            )
+            # Evict expired rows and anything past max_entries, least recently used first
+            conn.execute("DELETE FROM geocodes WHERE created_at <= ?", (now - self.ttl,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM geocodes").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM geocodes WHERE location IN "
+                    "(SELECT location FROM geocodes ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def is_missing(self, location: str) -> bool:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM misses WHERE location = ? AND created_at > ?", (location, self.clock() - self.miss_ttl)
+            ).fetchone()
+        return row is not None
+
+    def set_missing(self, location: str):
+        now = self.clock()
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO misses (location, created_at) VALUES (?, ?)", (location, now))
+            conn.execute("DELETE FROM misses WHERE created_at <= ?", (now - self.miss_ttl,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM misses").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM misses WHERE location IN (SELECT location FROM misses ORDER BY created_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def delete(self, location: str):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM geocodes WHERE location = ?", (location,))
+            conn.execute("DELETE FROM misses WHERE location = ?", (location,))
@@ -0,0 +1,409 @@
+"""Per-request instrumentation.
+
+Every request records how many SQL queries it ran and how long they took, the outbound HTTP
+calls made on its behalf and the time spent rendering Jinja templates. The totals end up in
+one compact log line, a Server-Timing header and Prometheus style metrics at /metrics.
+Metrics live in the process - with several gunicorn workers each one reports its own.
+
+Setting PROFILE_SLOW_REQUESTS_MS turns on a sampling profiler: stacks of in-flight requests are
+sampled on an interval and requests slower than the threshold get their folded stacks logged
+(or written to PROFILE_DIR, ready for flamegraph.pl / speedscope).
+"""
+from __future__ import annotations
+import ipaddress
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from flask import (
+    Response, abort, before_render_template, current_app, g, has_request_context, request, template_rendered
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from query_budget import query_count
+
+logger = logging.getLogger("bloggin.requests")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# Metrics - just enough of the Prometheus text format for counters and histograms
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _label_text(self, values, extra=()) -> str:
+        pairs = [*zip(self.labels, values), *extra]
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class CounterMetric(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount=1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._label_text(values)} {total:g}")
+        return lines
+
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self._values.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for values, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry):
+                    lines.append(f"{self.name}_bucket{self._label_text(values, [('le', f'{bound:g}')])} {count}")
+                lines.append(f"{self.name}_bucket{self._label_text(values, [('le', '+Inf')])} {entry[-1]}")
+                lines.append(f"{self.name}_sum{self._label_text(values)} {entry[-2]:g}")
+                lines.append(f"{self.name}_count{self._label_text(values)} {entry[-1]}")
+        return lines
+
+
+class GaugeMetric(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        # label values -> function returning the current value, read at scrape time
+        self._sources: dict[tuple, object] = {}
+
+    def track(self, source, *label_values):
+        with self._lock:
+            self._sources[label_values] = source
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        with self._lock:
+            for values, source in sorted(self._sources.items()):
+                lines.append(f"{self.name}{self._label_text(values)} {source():g}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def counter(self, name, help, labels=()) -> CounterMetric:
+        metric = CounterMetric(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DURATION_BUCKETS) -> HistogramMetric:
+        metric = HistogramMetric(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, labels=()) -> GaugeMetric:
+        metric = GaugeMetric(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter("bloggin_http_requests_total", "Requests served", ("endpoint", "method", "status"))
+http_duration = metrics.histogram("bloggin_http_request_duration_seconds", "Request duration", ("endpoint",))
+sql_duration = metrics.histogram("bloggin_sql_query_duration_seconds", "Duration of single SQL queries")
+sql_per_request = metrics.histogram(
+    "bloggin_sql_queries_per_request", "SQL queries run by one request", ("endpoint",), buckets=QUERY_BUCKETS
+)
+render_duration = metrics.histogram("bloggin_template_render_seconds", "Jinja render time", ("template",))
+outbound_duration = metrics.histogram(
+    "bloggin_outbound_request_duration_seconds", "Outbound HTTP calls", ("host", "status")
+)
+
+pool_wait = metrics.histogram(
+    "bloggin_db_pool_wait_seconds", "Time spent waiting for a pooled connection", ("bind",),
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+pool_checkouts = metrics.counter("bloggin_db_pool_checkouts_total", "Connections checked out of the pool", ("bind",))
+pool_checked_out = metrics.gauge("bloggin_db_pool_checked_out", "Connections in use right now", ("bind",))
+pool_size = metrics.gauge("bloggin_db_pool_size", "Configured pool size", ("bind",))
+pool_overflow = metrics.gauge("bloggin_db_pool_overflow", "Connections open beyond the pool size", ("bind",))
+
+
+@dataclass
+class RequestStats:
+    started: float = field(default_factory=time.perf_counter)
+    # The query count is query_budget's, budgets and these numbers always agree
+    sql_seconds: float = 0.0
+    render_seconds: float = 0.0
+    pool_wait_seconds: float = 0.0
+    # (host, status, seconds) for each outbound call
+    outbound: list = field(default_factory=list)
+    finished: bool = False
+
+
+def current_stats() -> RequestStats | None:
+    if has_request_context():
+        return g.get("request_stats")
+    return None
+
+
+# SQL timing for every engine - the start time is kept on the connection
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _query_finished(started: float):
+    elapsed = time.perf_counter() - started
+    sql_duration.observe(elapsed)
+    stats = current_stats()
+    if stats is not None:
+        stats.sql_seconds += elapsed
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    _query_finished(conn.info["query_started"].pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed_query(exception_context):
+    # Failed queries took time too, and query_budget counted them
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        _query_finished(started.pop())
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of threads serving requests, keeps them only for slow requests."""
+
+    def __init__(self, threshold_ms: float, interval_ms: float = 5, output_dir: str | None = None, top=10):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.top = top
+        # thread id -> Counter of folded stacks
+        self._active: dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def fold(frame) -> str:
+        # Root first, "file:function:line" joined by ";" - the folded format flame graph tools read
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self.fold(frame)] += 1
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._thread.start()
+
+    def end(self, seconds: float, label: str):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or seconds < self.threshold:
+            return
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{label.strip('/').replace('/', '_') or 'index'}.folded"
+            with open(os.path.join(self.output_dir, name), "w") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+            logger.warning("slow request %s %.0fms, profile written to %s", label, seconds * 1000, name)
+        else:
+            top = "\n".join(f"  {count:5d} {stack}" for stack, count in samples.most_common(self.top))
+            logger.warning("slow request %s %.0fms, top sampled stacks:\n%s", label, seconds * 1000, top)
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.profiler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("REQUEST_LOG", True)
+        app.config.setdefault("SERVER_TIMING", True)
+        app.config.setdefault("METRICS_ENDPOINT", True)
+        app.config.setdefault("PROFILE_SLOW_REQUESTS_MS", None)
+        app.config.setdefault("PROFILE_INTERVAL_MS", 5)
+        app.config.setdefault("PROFILE_DIR", None)
+
+        if app.config["PROFILE_SLOW_REQUESTS_MS"]:
+            self.profiler = SlowRequestProfiler(
+                float(app.config["PROFILE_SLOW_REQUESTS_MS"]),
+                interval_ms=float(app.config["PROFILE_INTERVAL_MS"]),
+                output_dir=app.config["PROFILE_DIR"]
+            )
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        if app.config["METRICS_ENDPOINT"]:
+            app.add_url_rule("/metrics", "metrics", self.metrics_view)
+        app.extensions["instrumentation"] = self
+
+    def watch_engines(self, engines: dict):
+        """Pool wait times, checkouts and usage for every engine, keyed by bind name."""
+        for bind, engine in engines.items():
+            bind = bind or "default"
+            pool = engine.pool
+
+            def observe_wait(seconds, bind=bind):
+                pool_wait.observe(seconds, bind)
+                stats = current_stats()
+                if stats is not None:
+                    stats.pool_wait_seconds += seconds
+
+            if hasattr(pool, "on_wait"):
+                pool.on_wait = observe_wait
+            event.listen(engine, "checkout", lambda *args, bind=bind: pool_checkouts.inc(bind))
+            if hasattr(pool, "checkedout"):
+                # engine.pool is looked up each time, dispose() swaps in a new pool
+                pool_checked_out.track(lambda engine=engine: engine.pool.checkedout(), bind)
+                pool_size.track(lambda engine=engine: engine.pool.size(), bind)
+                pool_overflow.track(lambda engine=engine: max(engine.pool.overflow(), 0), bind)
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+        if self.profiler is not None:
+            self.profiler.begin()
+
+    def _before_render(self, app, template, context, **extra):
+        g.setdefault("render_started", []).append(time.perf_counter())
+
+    def _after_render(self, app, template, context, **extra):
+        started = g.get("render_started")
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        render_duration.observe(elapsed, template.name)
+        stats = current_stats()
+        if stats is not None:
+            stats.render_seconds += elapsed
+
+    def record_outbound(self, host: str, status, seconds: float):
+        """HttpClient on_request hook - runs on whichever thread made the call."""
+        outbound_duration.observe(seconds, host, status or "error")
+        stats = current_stats()
+        if stats is not None:
+            stats.outbound.append((host, status, seconds))
+        else:
+            logger.debug("outbound host=%s status=%s dur_ms=%.1f", host, status or "error", seconds * 1000)
+
+    def _finish(self, stats: RequestStats, status: int, response=None):
+        stats.finished = True
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or "unmatched"
+        outbound_seconds = sum(seconds for _, _, seconds in stats.outbound)
+        sql_count = query_count()
+
+        http_requests.inc(endpoint, request.method, status)
+        http_duration.observe(elapsed, endpoint)
+        sql_per_request.observe(sql_count, endpoint)
+
+        if self.profiler is not None:
+            self.profiler.end(elapsed, request.path)
+
+        config = current_app.config
+        if response is not None and config["SERVER_TIMING"]:
+            timings = [
+                f"app;dur={elapsed * 1000:.1f}",
+                f'db;dur={stats.sql_seconds * 1000:.1f};desc="{sql_count} queries"',
+                f"render;dur={stats.render_seconds * 1000:.1f}",
+            ]
+            if stats.pool_wait_seconds:
+                timings.append(f"pool;dur={stats.pool_wait_seconds * 1000:.1f}")
+            if stats.outbound:
+                timings.append(f'outbound;dur={outbound_seconds * 1000:.1f};desc="{len(stats.outbound)} calls"')
+            response.headers.add("Server-Timing", ", ".join(timings))
+
+        if config["REQUEST_LOG"]:
+            line = (
+                f"{request.method} {request.path} {status} {elapsed * 1000:.1f}ms "
+                f"sql={sql_count}/{stats.sql_seconds * 1000:.1f}ms render={stats.render_seconds * 1000:.1f}ms"
+            )
+            if stats.outbound:
+                calls = ",".join(f"{host}:{status or 'error'}:{seconds * 1000:.0f}ms"
+                                 for host, status, seconds in stats.outbound)
+                line += f" out={calls}"
+            if response is not None and "X-Cache" in response.headers:
+                line += f" cache={response.headers['X-Cache']}"
+            logger.info(line)
+
+    def _after_request(self, response):
+        stats = current_stats()
+        if stats is not None and not stats.finished:
+            self._finish(stats, response.status_code, response)
+        return response
+
+    def _teardown_request(self, error=None):
+        # Requests that died with an exception never reach after_request
+        stats = current_stats()
+        if stats is not None and not stats.finished:
+            self._finish(stats, 500)
+
+    def metrics_view(self):
+        # Local scrapers only - the numbers say a lot about the server
+        if not ipaddress.ip_address(request.remote_addr or "0.0.0.0").is_loopback:
+            abort(404)
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,169 @@
+"""Outbound mail.
+
+Routes only write an OutboxMessage row. A background MailWorker picks up due messages in
+batches, sends them over one reused SMTP connection and retries failures with exponential
+backoff. The transport is pluggable - point SMTPTransport at a local debugging server
+(e.g. `python -m aiosmtpd -n -l localhost:1025`) to try it out without Gmail.
+"""
+from __future__ import annotations
+import logging
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from sqlalchemy import or_
+
+from database import db, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPTransport:
+    def __init__(self, host, port=587, username=None, password=None, use_tls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._conn = None
+
+    def _connect(self):
+        conn = smtplib.SMTP(host=self.host, port=self.port, timeout=self.timeout)
+        if self.use_tls:
+            conn.starttls()
+        if self.username:
+            conn.login(self.username, self.password)
+        return conn
+
+    def send(self, message: EmailMessage):
+        # Reuse the authenticated connection, reconnect once if the server dropped it
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            self._conn.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self._conn = self._connect()
+            self._conn.send_message(message)
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._conn = None
+
+
+class MailWorker:
+    def __init__(self, app, transport, from_addr, batch_size=20, poll_interval=5, max_attempts=8,
+                 base_backoff=30, lease=300, idle_timeout=60):
+        self.app = app
+        self.transport = transport
+        self.from_addr = from_addr
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.lease = lease
+        self.idle_timeout = idle_timeout
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # start() runs on every request, concurrently on gthread workers
+        self._start_lock = threading.Lock()
+
+    def build_message(self, outbox_message: OutboxMessage) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = self.from_addr
+        message["To"] = outbox_message.to_addr
+        message["Subject"] = outbox_message.subject
+        message.set_content(outbox_message.body)
+        return message
+
+    def _claim_batch(self, now):
+        # Lock due rows for this worker - the UPDATE only succeeds if nobody else holds them
+        due = db.session.execute(
+            db.select(OutboxMessage.id)
+            .where(
+                OutboxMessage.sent_at.is_(None),
+                OutboxMessage.attempts < self.max_attempts,
+                OutboxMessage.next_attempt_at <= now,
+                or_(OutboxMessage.locked_until.is_(None), OutboxMessage.locked_until < now)
+            )
+            .order_by(OutboxMessage.next_attempt_at)
+            .limit(self.batch_size)
+        ).scalars().all()
+        claimed = []
+        for message_id in due:
+            result = db.session.execute(
+                db.update(OutboxMessage)
+                .where(
+                    OutboxMessage.id == message_id,
+                    or_(OutboxMessage.locked_until.is_(None), OutboxMessage.locked_until < now)
+                )
+                .values(locked_until=now + timedelta(seconds=self.lease))
+            )
+            if result.rowcount:
+                claimed.append(message_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return db.session.execute(db.select(OutboxMessage).where(OutboxMessage.id.in_(claimed))).scalars().all()
+
+    def send_due(self) -> int:
+        """Send one batch of due messages, returns how many were picked up."""
+        now = datetime.now()
+        batch = self._claim_batch(now)
+        for outbox_message in batch:
+            try:
+                self.transport.send(self.build_message(outbox_message))
+            except Exception as error:
+                outbox_message.attempts += 1
+                outbox_message.last_error = str(error)
+                outbox_message.next_attempt_at = now + timedelta(
+                    seconds=self.base_backoff * 2 ** (outbox_message.attempts - 1)
+                )
+                logger.warning("Sending outbox message %s failed (attempt %s): %s",
+                               outbox_message.id, outbox_message.attempts, error)
+                # Start the next message on a fresh connection
+                self.transport.close()
+            else:
+                outbox_message.sent_at = datetime.now()
+            outbox_message.locked_until = None
+        db.session.commit()
+        return len(batch)
+
+    def _run(self):
+        last_sent = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    sent = self.send_due()
+            except Exception:
+                logger.exception("Mail worker batch failed")
+                sent = 0
+            if sent:
+                last_sent = time.monotonic()
+            if sent < self.batch_size:
+                # Nothing left for now - keep the connection for a while, then hang up
+                if time.monotonic() - last_sent > self.idle_timeout:
+                    self.transport.close()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="mail-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
@@ -0,0 +1,105 @@
+"""Schema upgrades for databases created before a column or index existed.
+
+db.create_all() only creates missing tables, so existing posts.db/Postgres databases are
+brought up to date with `flask upgrade-db`. Every step checks what is already there first and
+can be re-run safely.
+"""
+from __future__ import annotations
+from datetime import datetime
+
+from sqlalchemy import JSON, DateTime, Integer, String, bindparam, inspect, select, text, update
+
+from database import db, BlogPosts, Comment
+import content
+import counters
+import search
+
+BATCH_SIZE = 1000
+
+
+def has_column(conn, table: str, column: str) -> bool:
+    return column in {col["name"] for col in inspect(conn).get_columns(table)}
+
+
+def add_column(conn, table: str, column: str, column_type, default=None):
+    if not has_column(conn, table, column):
+        type_sql = column_type.compile(dialect=conn.dialect)
+        if default is not None:
+            type_sql += f" NOT NULL DEFAULT {default}"
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {type_sql}"))
+
+
+def parse_post_date(date: str) -> datetime | None:
+    # Old posts were stamped with "%B %w, %Y" - %w is the weekday, so only month and year are real
+    try:
+        return datetime.strptime(date, "%B %w, %Y").replace(day=1)
+    except (TypeError, ValueError):
+        return None
+
+
+def add_post_created_at(conn):
+    add_column(conn, "blog_posts", "created_at", DateTime())
+
+    posts = BlogPosts.__table__
+    rows = conn.execute(select(posts.c.id, posts.c.date).where(posts.c.created_at.is_(None))).all()
+    fallback = datetime.now()
+    stmt = update(posts).where(posts.c.id == bindparam("post_id")).values(created_at=bindparam("stamp"))
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.execute(stmt, [
+            {"post_id": post_id, "stamp": parse_post_date(date) or fallback}
+            for post_id, date in rows[start:start + BATCH_SIZE]
+        ])
+
+
+def create_indexes(conn):
+    for table in (BlogPosts.__table__, Comment.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def build_search_index(conn):
+    # Tables only - index_rendered_content fills them once body_html exists
+    search.search_backend(conn.dialect.name).create(conn)
+
+
+def add_counters(conn):
+    added = not has_column(conn, "users", "post_count") or not has_column(conn, "blog_posts", "comment_count")
+    add_column(conn, "users", "post_count", Integer(), default=0)
+    add_column(conn, "blog_posts", "comment_count", Integer(), default=0)
+    if added:
+        counters.repair(conn)
+
+
+def add_rendered_content(conn):
+    add_column(conn, "blog_posts", "body_html", String())
+    add_column(conn, "blog_posts", "excerpt", String(255))
+    add_column(conn, "blog_posts", "reading_minutes", Integer())
+    add_column(conn, "blog_posts", "image_urls", JSON())
+    add_column(conn, "comments", "body_html", String())
+    # Only rows without body_html - cheap to re-run
+    content.backfill(conn)
+
+
+def index_rendered_content(conn):
+    # Only the first time - afterwards the routes keep the index up to date
+    backend = search.search_backend(conn.dialect.name)
+    if conn.execute(text("SELECT COUNT(*) FROM post_search")).scalar() == 0:
+        search.rebuild(backend, conn)
+
+
+# Run in order, new steps go at the end
+STEPS = [
+    add_post_created_at,
+    create_indexes,
+    build_search_index,
+    add_counters,
+    add_rendered_content,
+    index_rendered_content,
+]
+
+
+def upgrade():
+    db.create_all()
+    with db.engine.begin() as conn:
+        for step in STEPS:
+            step(conn)
@@ -0,0 +1,275 @@
+"""News headlines and weather forecasts for the home page.
+
+The upstream APIs are only called from a background refresher thread, the routes read the
+last known values out of the shared cache.
+"""
+from __future__ import annotations
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from outbound import Deadline
+
+logger = logging.getLogger(__name__)
+
+# Overridable so benchmarks can point the refresher at local stub servers
+NEWS_ENDPOINT = os.environ.get("NEWS_ENDPOINT", "https://newsapi.org/v2/top-headlines")
+WEATHER_POINTS_ENDPOINT = os.environ.get("WEATHER_POINTS_ENDPOINT", "https://api.weather.gov/points")
+IP_GEOCODE_ENDPOINT = os.environ.get("IP_GEOCODE_ENDPOINT", "http://ipinfo.io")
+# host[:port] and scheme of a Nominatim server
+NOMINATIM_DOMAIN = os.environ.get("NOMINATIM_DOMAIN", "nominatim.openstreetmap.org")
+NOMINATIM_SCHEME = os.environ.get("NOMINATIM_SCHEME", "https")
+
+SERVER_LOCATION = "server"
+
+
+def normalize_location(location: str | None) -> str:
+    # "  New York,  NY " and "new york, ny" share a cache entry
+    if not location:
+        return SERVER_LOCATION
+    return " ".join(location.lower().split())
+
+
+# Upstream calls - each takes the shared HttpClient and an optional Deadline for the whole chain
+def fetch_news(client, api_key, deadline=None):
+    news_params = {
+        "apiKey": api_key,
+        "pageSize": 10,
+        "country": "us"
+    }
+    return client.get_json(NEWS_ENDPOINT, params=news_params, deadline=deadline)["articles"]
+
+
+def server_coords(client, deadline=None):
+    # Server's location based on its IP - ipinfo answers with "loc": "lat,lng"
+    ip_data = client.get_json(f"{IP_GEOCODE_ENDPOINT}/json", deadline=deadline)
+    if not ip_data.get("loc"):
+        return None
+    lat, lng = ip_data["loc"].split(",")
+    return float(lat), float(lng)
+
+
+_nominatim = None
+
+
+def geocode(client, location, deadline=None):
+    # Geolocation - NOM API Call, None if the location can't be found
+    global _nominatim
+    if _nominatim is None:
+        import geopy.geocoders
+        _nominatim = geopy.geocoders.Nominatim(
+            user_agent=client.user_agent, domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME
+        )
+    started = time.perf_counter()
+    status = None
+    try:
+        user_coords = _nominatim.geocode(
+            query=location,
+            addressdetails=True,
+            geometry="geojson",
+            extratags=True,
+            timeout=client.timeout(deadline)[1]
+        )
+        status = 200
+    finally:
+        client.observe(NOMINATIM_DOMAIN, status, time.perf_counter() - started)
+    if user_coords is None:
+        return None
+    return user_coords.latitude, user_coords.longitude
+
+
+def lookup_point(client, lat, lng, deadline=None):
+    # Find the nearest weather station and its forecast url
+    weather_data = client.get_json(f"{WEATHER_POINTS_ENDPOINT}/{lat},{lng}", deadline=deadline)
+    location_details = weather_data["properties"]["relativeLocation"]["properties"]
+    return {
+        "lat": lat,
+        "lng": lng,
+        "forecast_url": weather_data["properties"]["forecast"],
+        "city": location_details["city"],
+        "state": location_details["state"]
+    }
+
+
+def fetch_forecast(client, point, deadline=None):
+    forecast_data = client.get_json(point["forecast_url"], deadline=deadline)
+    return {
+        "weather": forecast_data["properties"]["periods"],
+        "location": {
+            "city": point["city"],
+            "state": point["state"]
+        }
+    }
+
+
+class NewsWeatherRefresher:
+    """Refreshes headlines and forecasts on an interval and stores them in the cache.
+
+    Every worker runs a refresher, a short lived lock key in the cache makes sure only one of
+    them calls the upstream APIs per interval. Failed refreshes leave the last value in place.
+    Coordinates and forecast urls come from the persistent geocode cache when possible.
+    """
+
+    def __init__(self, cache, client, geocodes, news_api_key=None, interval=600, stale_ttl=6 * 3600,
+                 max_locations=50, call_deadline=15, on_update=None):
+        self.cache = cache
+        # Called with the cache key after every successful refresh
+        self.on_update = on_update
+        self.client = client
+        self.geocodes = geocodes
+        self.call_deadline = call_deadline
+        self.news_api_key = news_api_key
+        self.interval = interval
+        self.stale_ttl = stale_ttl
+        self.max_locations = max_locations
+        # Locations users asked for -> last time they were asked for
+        self._locations: OrderedDict = OrderedDict()
+        self._locations_lock = threading.Lock()
+        self._pending: queue.Queue = queue.Queue()
+        self._waiting: dict = {}
+        self._stop = threading.Event()
+        self._thread = None
+        # start() runs on every request, concurrently on gthread workers
+        self._start_lock = threading.Lock()
+
+    # Reads for the routes
+    def _read(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None, None
+        return entry["data"], datetime.fromisoformat(entry["updated_at"])
+
+    def news(self):
+        return self._read("news")
+
+    def forecast(self, location=None, wait=0.0):
+        key = normalize_location(location)
+        data, updated_at = self._read(f"weather:{key}")
+        if data is None and key != SERVER_LOCATION:
+            # Ask the refresher for this location once, it starts tracking the location if it resolves
+            with self._locations_lock:
+                done = self._waiting.get(key)
+                if done is None:
+                    done = self._waiting[key] = threading.Event()
+                    self._pending.put(key)
+            if wait:
+                # Give it a moment to land in the cache
+                done.wait(wait)
+                data, updated_at = self._read(f"weather:{key}")
+        elif key != SERVER_LOCATION:
+            self._track(key)
+        return data, updated_at
+
+    # Refreshing
+    def _store(self, key, data):
+        self.cache.set(key, {"data": data, "updated_at": datetime.now().isoformat()}, ttl=self.stale_ttl)
+        if self.on_update is not None:
+            self.on_update(key)
+
+    def _claim(self, key) -> bool:
+        # Lock expires a little before the next tick so the next refresh can claim it again
+        return self.cache.add(f"lock:{key}", os.getpid(), ttl=self.interval * 0.9)
+
+    def _track(self, key):
+        with self._locations_lock:
+            self._locations[key] = time.monotonic()
+            self._locations.move_to_end(key)
+            while len(self._locations) > self.max_locations:
+                self._locations.popitem(last=False)
+
+    def _tracked_locations(self):
+        cutoff = time.monotonic() - self.stale_ttl
+        with self._locations_lock:
+            for key in [key for key, seen in self._locations.items() if seen < cutoff]:
+                del self._locations[key]
+            return list(self._locations)
+
+    def refresh_news(self):
+        try:
+            self._store("news", fetch_news(self.client, self.news_api_key, Deadline(self.call_deadline)))
+        except Exception as error:
+            logger.warning("News refresh failed, keeping the last headlines: %s", error)
+
+    def refresh_forecast(self, key):
+        # One deadline for the whole geocode -> points -> forecast chain
+        deadline = Deadline(self.call_deadline)
+        try:
+            point = self.resolve_point(key, deadline)
+            if point is None:
+                logger.info("Location %r not found", key)
+                return
+            self._store(f"weather:{key}", fetch_forecast(self.client, point, deadline=deadline))
+            if key != SERVER_LOCATION:
+                # Only locations that resolved take one of the max_locations slots
+                self._track(key)
+        except Exception as error:
+            logger.warning("Weather refresh for %r failed, keeping the last forecast: %s", key, error)
+
+    def resolve_point(self, key, deadline=None):
+        # Geocode + weather station lookups rarely change, only make them on a geocode cache miss
+        point = self.geocodes.get(key)
+        if point is not None:
+            return point
+        if self.geocodes.is_missing(key):
+            return None
+        if key == SERVER_LOCATION:
+            coords = server_coords(self.client, deadline)
+        else:
+            coords = geocode(self.client, key, deadline)
+        if coords is None:
+            # Not found, as opposed to failing - don't ask Nominatim again for a while
+            self.geocodes.set_missing(key)
+            return None
+        point = lookup_point(self.client, *coords, deadline=deadline)
+        self.geocodes.set(key, point)
+        return point
+
+    def refresh_all(self):
+        # News and each weather chain are independent - run them side by side
+        calls = []
+        if self._claim("news"):
+            calls.append(self.refresh_news)
+        for key in [SERVER_LOCATION, *self._tracked_locations()]:
+            if self._claim(f"weather:{key}"):
+                calls.append(lambda key=key: self.refresh_forecast(key))
+        self.client.gather(*calls)
+
+    def _run(self):
+        # Resolve the server's own location once at startup, later refreshes read it from the geocode cache
+        try:
+            self.resolve_point(SERVER_LOCATION, Deadline(self.call_deadline))
+        except Exception as error:
+            logger.warning("Could not resolve the server's location: %s", error)
+        while not self._stop.is_set():
+            self.refresh_all()
+            deadline = time.monotonic() + self.interval
+            while not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    key = self._pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if key is None:
+                    continue
+                self.refresh_forecast(key)
+                with self._locations_lock:
+                    done = self._waiting.pop(key, None)
+                if done is not None:
+                    done.set()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="news-weather-refresher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._pending.put(None)
@@ -0,0 +1,186 @@
+"""Outbound HTTP for the news, weather and geocoding APIs.
+
+Keeps one keep-alive session per upstream host, puts a deadline on every call and runs
+independent calls at the same time on a small thread pool.
+"""
+from __future__ import annotations
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from urllib.parse import urljoin, urlsplit
+
+if TYPE_CHECKING:
+    import requests
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class ResponseTooLarge(ValueError):
+    pass
+
+
+class TooManyRedirects(ValueError):
+    pass
+
+
+class Deadline:
+    """Time budget shared by a chain of calls, e.g. points -> forecast."""
+
+    def __init__(self, seconds: float, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + seconds
+
+    def remaining(self) -> float:
+        remaining = self.expires_at - self.clock()
+        if remaining <= 0:
+            raise DeadlineExceeded("Outbound call deadline exceeded")
+        return remaining
+
+
+def _checked_adapter(check_address, **adapter_options):
+    # An adapter whose connections pass the address they actually reached to check_address before
+    # sending anything - a second DNS answer can't swap in another host after the URL was checked
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def checked(connection_class):
+        class CheckedConnection(connection_class):
+            def _new_conn(self):
+                sock = super()._new_conn()
+                try:
+                    check_address(sock.getpeername()[0])
+                except BaseException:
+                    sock.close()
+                    raise
+                return sock
+        return CheckedConnection
+
+    class CheckedHTTPPool(HTTPConnectionPool):
+        ConnectionCls = checked(HTTPConnection)
+
+    class CheckedHTTPSPool(HTTPSConnectionPool):
+        ConnectionCls = checked(HTTPSConnection)
+
+    class CheckedAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": CheckedHTTPPool, "https": CheckedHTTPSPool}
+
+    return CheckedAdapter(**adapter_options)
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=3.05, read_timeout=10, pool_size=4, max_workers=4, user_agent="blogger_app",
+                 on_request=None, check_address=None):
+        # Called with (host, status or None, seconds) after every call
+        self.on_request = on_request
+        # Called with the IP of every new connection, raises to refuse it
+        self.check_address = check_address
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.user_agent = user_agent
+        self._sessions: dict[str, requests.Session] = {}
+        self._sessions_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="outbound")
+
+    def session_for(self, url: str) -> requests.Session:
+        # One persistent session per scheme://host so connections are reused between calls
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._sessions_lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                # requests is imported with the first outbound call, not with the app
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.headers["User-Agent"] = self.user_agent
+                if self.check_address is None:
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                else:
+                    adapter = _checked_adapter(self.check_address, pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount(origin, adapter)
+                self._sessions[origin] = session
+            return session
+
+    def timeout(self, deadline: Deadline | None = None):
+        if deadline is None:
+            return self.connect_timeout, self.read_timeout
+        remaining = deadline.remaining()
+        return min(self.connect_timeout, remaining), min(self.read_timeout, remaining)
+
+    def observe(self, host: str, status, seconds: float):
+        if self.on_request is not None:
+            self.on_request(host, status, seconds)
+
+    def get_json(self, url: str, params=None, deadline: Deadline | None = None, **kwargs):
+        started = time.perf_counter()
+        status = None
+        try:
+            response = self.session_for(url).get(url, params=params, timeout=self.timeout(deadline), **kwargs)
+            status = response.status_code
+            response.raise_for_status()
+            return response.json()
+        finally:
+            self.observe(urlsplit(url).netloc, status, time.perf_counter() - started)
+
+    def get_bytes(self, url: str, max_bytes: int, deadline: Deadline | None = None, check_url=None,
+                  max_redirects: int = 5, **kwargs) -> bytes:
+        # Streams the body and gives up as soon as it passes max_bytes. Redirects are followed here
+        # rather than by requests so check_url(url) sees every hop before it is requested
+        for _ in range(max_redirects + 1):
+            if check_url is not None:
+                check_url(url)
+            host = urlsplit(url).netloc
+            started = time.perf_counter()
+            status = None
+            try:
+                with self.session_for(url).get(
+                    url, timeout=self.timeout(deadline), stream=True, allow_redirects=False, **kwargs
+                ) as response:
+                    status = response.status_code
+                    if response.is_redirect:
+                        url = urljoin(url, response.headers["Location"])
+                        continue
+                    response.raise_for_status()
+                    if int(response.headers.get("Content-Length") or 0) > max_bytes:
+                        raise ResponseTooLarge(f"{url} is larger than {max_bytes} bytes")
+                    chunks, size = [], 0
+                    while True:
+                        # read1 returns whatever has arrived, the timeouts only bound each socket read -
+                        # a slow drip still has to finish within the deadline
+                        chunk = response.raw.read1(64 * 1024, decode_content=True)
+                        if not chunk:
+                            return b"".join(chunks)
+                        if deadline is not None:
+                            deadline.remaining()
+                        size += len(chunk)
+                        if size > max_bytes:
+                            raise ResponseTooLarge(f"{url} is larger than {max_bytes} bytes")
+                        chunks.append(chunk)
+            finally:
+                self.observe(host, status, time.perf_counter() - started)
+        raise TooManyRedirects(f"More than {max_redirects} redirects")
+
+    def gather(self, *calls):
+        # Run the calls at the same time, returns (result, error) pairs in the same order
+        futures = [self.executor.submit(call) for call in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except Exception as error:
+                results.append((None, error))
+        return results
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,151 @@
+"""Full-response cache for anonymous GETs.
+
+Views tag what they render (post:42, user:7, ...) and writes invalidate tags. Every tag has a
+random version token in the shared cache, a cached page remembers the versions it was rendered
+with and is thrown away as soon as one of them changes. Logged-in users skip the cache unless a
+view is marked shared (nothing on it depends on who is asking, e.g. feeds).
+
+Views only know their tags once they have queried, so the versions can't be read before the
+render. Instead every invalidation first bumps a generation token, and a render that saw the
+generation change while it ran isn't stored - it may show data from before the write.
+"""
+from __future__ import annotations
+import hashlib
+import uuid
+from functools import wraps
+
+from flask import current_app, g, get_flashed_messages, make_response, request, session
+from flask_login import current_user
+
+from cache import make_cache
+
+CSRF_PLACEHOLDER = "__page_cache_csrf_token__"
+
+
+class PageCache:
+    def __init__(self, cache=None, default_ttl: float = 300):
+        # Without a cache, init_app() gives every app its own, built from its config
+        self._cache = cache
+        self._default_ttl = default_ttl
+
+    def init_app(self, app):
+        app.config.setdefault("REDIS_URL", None)
+        app.config.setdefault("PAGE_CACHE_SECONDS", self._default_ttl)
+        app.config.setdefault("PAGE_CACHE_SIZE", 2048)
+        app.extensions["page_cache"] = make_cache(app.config["REDIS_URL"], max_entries=app.config["PAGE_CACHE_SIZE"])
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else current_app.extensions["page_cache"]
+
+    @property
+    def default_ttl(self) -> float:
+        return self._default_ttl if self._cache is not None else current_app.config["PAGE_CACHE_SECONDS"]
+
+    # Tagging and invalidation
+    def tag(self, *tags: str):
+        g.setdefault("page_tags", set()).update(tags)
+
+    def invalidate(self, *tags: str):
+        # Generation first - a render that reads a new tag version then sees the new generation too
+        self.cache.set("generation", uuid.uuid4().hex)
+        for tag in tags:
+            self.cache.set(f"tag:{tag}", uuid.uuid4().hex)
+
+    def _versions(self, tags) -> dict:
+        tags = sorted(tags)
+        versions = dict(zip(tags, self.cache.get_many(f"tag:{tag}" for tag in tags)))
+        for tag, version in versions.items():
+            if version is None:
+                # First page with this tag - whoever wins add() sets the version everyone uses
+                self.cache.add(f"tag:{tag}", uuid.uuid4().hex)
+                versions[tag] = self.cache.get(f"tag:{tag}")
+        return versions
+
+    def _is_fresh(self, entry) -> bool:
+        tags = entry["tags"]
+        current = self.cache.get_many(f"tag:{tag}" for tag in tags)
+        return all(version is not None and version == tags[tag] for tag, version in zip(tags, current))
+
+    # Request handling
+    @staticmethod
+    def cacheable() -> bool:
+        # Only anonymous GETs without pending flash messages share pages
+        return (
+            request.method == "GET"
+            and not current_user.is_authenticated
+            and not session.get("_flashes")
+            and current_app.config.get("PAGE_CACHE_ENABLED", True)
+        )
+
+    @staticmethod
+    def shared_cacheable() -> bool:
+        # Same response for everybody - sessions and flashes don't matter, and aren't touched
+        return request.method == "GET" and current_app.config.get("PAGE_CACHE_ENABLED", True)
+
+    @staticmethod
+    def _csrf_field():
+        return current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token")
+
+    def _serve(self, entry):
+        body = entry["body"]
+        if CSRF_PLACEHOLDER in body:
+            # Cached forms get this visitor's own CSRF token
+            from flask_wtf.csrf import generate_csrf
+            body = body.replace(CSRF_PLACEHOLDER, generate_csrf())
+        response = make_response(body, entry["status"])
+        response.mimetype = entry["mimetype"]
+        response.headers["X-Cache"] = "HIT"
+        return response
+
+    def _store(self, key, response, ttl, generation) -> dict:
+        body = response.get_data(as_text=True)
+        token = g.get(self._csrf_field())
+        if token:
+            body = body.replace(token, CSRF_PLACEHOLDER)
+        entry = {
+            "body": body,
+            "status": response.status_code,
+            "mimetype": response.mimetype,
+            "tags": self._versions(g.get("page_tags", ())),
+            # Only meaningful for bodies that are the same for every visitor (no CSRF token)
+            "etag": hashlib.sha256(body.encode()).hexdigest()[:32],
+        }
+        # Read after the versions - unchanged means no write was invalidated during the render
+        if self.cache.get("generation") == generation:
+            self.cache.set(key, entry, ttl=ttl)
+        return entry
+
+    def cached(self, ttl: float | None = None, shared: bool = False, etag: bool = False):
+        """Cache the view's 200 responses until ttl passes or one of its tags is invalidated.
+
+        shared=True caches for logged-in users too, etag=True adds an ETag and answers matching
+        If-None-Match requests with 304.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if not (self.shared_cacheable() if shared else self.cacheable()):
+                    return view(*args, **kwargs)
+
+                # Feeds and JSON carry absolute URLs - one entry per scheme and host they were built for
+                key = f"page:{request.scheme}://{request.host}{request.full_path}"
+                entry = self.cache.get(key)
+                if entry is not None and self._is_fresh(entry):
+                    response = self._serve(entry)
+                else:
+                    generation = self.cache.get("generation")
+                    response = make_response(view(*args, **kwargs))
+                    entry = None
+                    # Don't share pages that flashed something or weren't a plain 200
+                    if response.status_code == 200 and (shared or not get_flashed_messages()):
+                        entry = self._store(key, response, ttl or self.default_ttl, generation)
+                    response.headers["X-Cache"] = "MISS"
+
+                # Entries stored before ETags existed have none, they get one on the next render
+                if etag and entry is not None and entry.get("etag"):
+                    response.set_etag(entry["etag"])
+                    response.make_conditional(request)
+                return response
+            return wrapper
+        return decorator
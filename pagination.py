@@ -0,0 +1,42 @@
+"""Keyset (cursor) pagination, newest first.
+
+Pages are fetched with WHERE id < cursor ORDER BY id DESC LIMIT n so page N costs the same as
+page 1 no matter how many rows are in the table.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+
+from database import db
+
+
+@dataclass
+class Page:
+    items: list = field(default_factory=list)
+    # Pass as ?before= to get older items, ?after= to get newer items
+    next_cursor: int | None = None
+    prev_cursor: int | None = None
+
+
+def keyset_page(query, column, page_size: int, before: int | None = None, after: int | None = None) -> Page:
+    if after is not None:
+        # Walk forward from the cursor, then flip back to newest first
+        query = query.where(column > after).order_by(column.asc())
+    else:
+        if before is not None:
+            query = query.where(column < before)
+        query = query.order_by(column.desc())
+
+    # One extra row tells us if there is another page without a COUNT(*)
+    rows = db.session.execute(query.limit(page_size + 1)).scalars().all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    page = Page(items=rows)
+    if after is not None:
+        rows.reverse()
+        page.prev_cursor = rows[0].id if has_more and rows else None
+        page.next_cursor = rows[-1].id if rows else after + 1
+    else:
+        page.next_cursor = rows[-1].id if has_more else None
+        page.prev_cursor = rows[0].id if before is not None and rows else None
+    return page
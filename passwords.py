@@ -0,0 +1,95 @@
+"""Password hashing off the request worker.
+
+scrypt is deliberately slow and memory hungry, so hashing and checking run in a small process
+pool. At most max_workers hashes run at once and at most max_queue more may wait - anything
+beyond that raises HashingOverloaded straight away so the route can ask the user to try again.
+The limits are per gunicorn worker process and shared by its threads (the Procfile runs gthread
+workers). Keep max_workers + max_queue below the thread count so a login burst can't take every
+thread of a worker - the callers over the limit fail fast instead of waiting.
+"""
+from __future__ import annotations
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingOverloaded(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method="scrypt:32768:8:1", salt_length=16, max_workers=2, max_queue=8, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Set by init_app() - every app then hashes with its own pool, built from its config
+        self._per_app = False
+
+    def init_app(self, app):
+        app.config.setdefault("PASSWORD_HASH_METHOD", self.method)
+        app.config.setdefault("PASSWORD_SALT_LENGTH", self.salt_length)
+        app.config.setdefault("PASSWORD_HASH_WORKERS", self.max_workers)
+        app.config.setdefault("PASSWORD_HASH_QUEUE", 0)
+        app.config.setdefault("PASSWORD_HASH_TIMEOUT", self.timeout)
+        self._per_app = True
+        app.extensions["passwords"] = PasswordHasher(
+            method=app.config["PASSWORD_HASH_METHOD"],
+            salt_length=app.config["PASSWORD_SALT_LENGTH"],
+            max_workers=app.config["PASSWORD_HASH_WORKERS"],
+            max_queue=app.config["PASSWORD_HASH_QUEUE"],
+            timeout=app.config["PASSWORD_HASH_TIMEOUT"]
+        )
+
+    def _hasher(self) -> PasswordHasher:
+        return current_app.extensions["passwords"] if self._per_app else self
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Created on first use so every gunicorn worker gets its own pool after the fork. The hashing
+        # processes start from a clean forkserver rather than forking a threaded worker and its locks
+        with self._executor_lock:
+            if self._executor is None:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(method)
+                )
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingOverloaded("Too many password checks in progress")
+        try:
+            return self._pool().submit(fn, *args).result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingOverloaded("Password check timed out")
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        hasher = self._hasher()
+        return hasher._run(generate_password_hash, password, hasher.method, hasher.salt_length)
+
+    def verify(self, stored_hash: str, password: str) -> bool:
+        return self._hasher()._run(check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash: str) -> bool:
+        # Stored hashes look like "method$salt$hash" - upgrade when the method or salt length changed
+        hasher = self._hasher()
+        try:
+            method, salt, _ = stored_hash.split("$", 2)
+        except ValueError:
+            return True
+        return method != hasher.method or len(salt) != hasher.salt_length
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
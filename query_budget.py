@@ -0,0 +1,50 @@
+"""Per-request SQL query counting.
+
+Routes declare how many queries they may run with @query_budget(n). When the app is testing
+(or ENFORCE_QUERY_BUDGETS is set) going over the budget fails the request, so an N+1 that
+sneaks into a template shows up as a failing test instead of a slow page. This is the only
+query counter - X-Query-Count, Server-Timing, the request log and /metrics all read query_count().
+"""
+from __future__ import annotations
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+
+def query_count() -> int:
+    return g.get("query_count", 0)
+
+
+def query_budget(limit: int):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = view(*args, **kwargs)
+            enforce = current_app.config.get("ENFORCE_QUERY_BUDGETS", current_app.testing)
+            if enforce and query_count() > limit:
+                raise QueryBudgetExceeded(
+                    f"{request.endpoint} ran {query_count()} queries, budget is {limit}"
+                )
+            return response
+        wrapper.query_budget = limit
+        return wrapper
+    return decorator
+
+
+def report_query_count(response):
+    # after_request hook - lets load tests read queries per request off the response
+    if current_app.config.get("QUERY_COUNT_HEADER"):
+        response.headers["X-Query-Count"] = str(query_count())
+    return response
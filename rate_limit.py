@@ -0,0 +1,215 @@
+"""Per-client rate limits and a concurrency cap for expensive routes.
+
+Every limited route has a token bucket per client (user id when logged in, otherwise the IP):
+"10/minute" holds up to 10 tokens and refills 10 per minute, each request takes one. Expensive
+routes also share a cap on how many of them run at once. Either one answers 429 with Retry-After
+before the view does any work. MemoryLimits keeps state in the process, RedisLimits shares it
+between gunicorn workers - both take a clock so tests can move time by hand.
+"""
+from __future__ import annotations
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import wraps
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+# In-flight slots older than this are assumed lost (worker killed mid-request) - gunicorn --timeout
+SLOT_TIMEOUT = 30
+
+
+@dataclass(frozen=True)
+class Limit:
+    capacity: int
+    # Tokens added back per second
+    rate: float
+
+
+def parse_limit(rule: str | None) -> Limit | None:
+    """Parse "5/minute" into Limit(5, 5/60), an empty rule means no limit."""
+    if not rule:
+        return None
+    count, _, period = rule.partition("/")
+    if period not in PERIODS or not count.strip().isdigit() or int(count) < 1:
+        raise ValueError(f"Bad rate limit {rule!r}, expected e.g. 10/minute")
+    return Limit(int(count), int(count) / PERIODS[period])
+
+
+def refill(tokens: float, updated: float, now: float, limit: Limit, cost: int = 1) -> tuple[float, float]:
+    """Token bucket step, returns (tokens left, seconds to wait). Zero wait means allowed."""
+    tokens = min(limit.capacity, tokens + max(0.0, now - updated) * limit.rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / limit.rate
+
+
+class MemoryLimits:
+    def __init__(self, clock=time.monotonic, max_entries: int = 10000):
+        self.clock = clock
+        self.max_entries = max_entries
+        # key -> (tokens, updated), least recently used first
+        self._buckets: OrderedDict = OrderedDict()
+        self._in_flight: dict = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, limit: Limit, cost: int = 1) -> float:
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.pop(key, (limit.capacity, now))
+            tokens, wait = refill(tokens, updated, now, limit, cost)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_entries:
+                # Forgetting a bucket only ever gives its client a full one again
+                self._buckets.popitem(last=False)
+            return wait
+
+    def acquire(self, key: str, limit: int) -> str | None:
+        with self._lock:
+            if self._in_flight.get(key, 0) >= limit:
+                return None
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            return key
+
+    def release(self, key: str, slot: str):
+        with self._lock:
+            self._in_flight[key] -= 1
+            if not self._in_flight[key]:
+                del self._in_flight[key]
+
+
+class RedisLimits:
+    """Buckets in Redis hashes, in-flight slots in sorted sets - both updated by Lua scripts."""
+
+    TAKE = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local capacity, rate, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+    local tokens, updated = tonumber(bucket[1]) or capacity, tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+    ACQUIRE = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+    if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then return 0 end
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+    """
+
+    def __init__(self, url: str, prefix: str = "bloggin:limit:", client=None, clock=time.time):
+        if client is None:
+            # Only pull redis in when a Redis backend is actually configured
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        # Wall clock - every worker has to agree on it
+        self.clock = clock
+        self._take = client.register_script(self.TAKE)
+        self._acquire = client.register_script(self.ACQUIRE)
+
+    def take(self, key: str, limit: Limit, cost: int = 1) -> float:
+        return float(self._take(keys=[self.prefix + key], args=[limit.capacity, limit.rate, self.clock(), cost]))
+
+    def acquire(self, key: str, limit: int) -> str | None:
+        slot = uuid.uuid4().hex
+        acquired = self._acquire(keys=[self.prefix + key], args=[self.clock(), SLOT_TIMEOUT, limit, slot])
+        return slot if acquired else None
+
+    def release(self, key: str, slot: str):
+        self.client.zrem(self.prefix + key, slot)
+
+
+def make_limits(url: str | None = None, **memory_options):
+    # Redis when a redis:// url is configured, like cache.make_cache()
+    if url and url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisLimits(url)
+    return MemoryLimits(**memory_options)
+
+
+def client_key() -> str:
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}"
+    return f"ip:{request.remote_addr}"
+
+
+class RateLimiter:
+    """Route decorators reading RATE_LIMITS ({name: "10/minute"}), EXPENSIVE_CONCURRENCY and
+    RATE_LIMIT_ENABLED from the app config on every request."""
+
+    def __init__(self, backend=None):
+        # Without a backend, init_app() gives every app its own, built from its config
+        self._backend = backend
+        self._parsed: dict = {}
+
+    def init_app(self, app):
+        app.config.setdefault("REDIS_URL", None)
+        app.extensions["rate_limits"] = make_limits(app.config["REDIS_URL"])
+
+    @property
+    def backend(self):
+        return self._backend if self._backend is not None else current_app.extensions["rate_limits"]
+
+    def _limit(self, name: str) -> Limit | None:
+        rule = current_app.config.get("RATE_LIMITS", {}).get(name)
+        if rule not in self._parsed:
+            self._parsed[rule] = parse_limit(rule)
+        return self._parsed[rule]
+
+    @staticmethod
+    def reject(wait: float):
+        raise TooManyRequests("Too many requests, please slow down.", retry_after=max(1, math.ceil(wait)))
+
+    def check(self, name: str):
+        limit = self._limit(name)
+        if limit is None:
+            return
+        try:
+            wait = self.backend.take(f"{name}:{client_key()}", limit)
+        except Exception:
+            # A broken limiter shouldn't take the site down with it - let the request through
+            logger.warning("Rate limit check for %s failed", name, exc_info=True)
+            return
+        if wait > 0:
+            self.reject(wait)
+
+    def limit(self, name: str, methods=("GET", "POST"), expensive: bool = False):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in methods or not current_app.config.get("RATE_LIMIT_ENABLED", True):
+                    return view(*args, **kwargs)
+                self.check(name)
+                if not expensive:
+                    return view(*args, **kwargs)
+
+                try:
+                    slot = self.backend.acquire("expensive", current_app.config["EXPENSIVE_CONCURRENCY"])
+                except Exception:
+                    logger.warning("Concurrency check for %s failed", name, exc_info=True)
+                    return view(*args, **kwargs)
+                if slot is None:
+                    # Full up - shed the request now rather than queue it behind the others
+                    self.reject(1)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    try:
+                        self.backend.release("expensive", slot)
+                    except Exception:
+                        # Redis slots time out on their own after SLOT_TIMEOUT
+                        logger.warning("Releasing the %s slot failed", name, exc_info=True)
+            return wrapper
+        return decorator
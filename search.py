@@ -0,0 +1,263 @@
+"""Full-text search over posts and comments.
+
+SQLite uses FTS5 virtual tables, Postgres uses tsvector columns with GIN indexes. Both keep a
+post table (title, subtitle, body) and a comment table keyed like the real rows, updated in the
+same transaction as the post/comment they index, so there are no full rebuilds after setup.
+Backend methods take anything with .execute() - db.session in routes, a Connection in migrations.
+"""
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, select, text
+
+from database import BlogPosts, Comment
+
+# Snippet highlight markers - swapped for <mark> after the snippet text is escaped
+START_MARK = "\x02"
+STOP_MARK = "\x03"
+BATCH_SIZE = 500
+
+
+@dataclass
+class SearchHit:
+    post_id: int
+    rank: float
+    snippet: str
+
+    @property
+    def snippet_html(self) -> Markup:
+        return Markup(
+            str(escape(self.snippet)).replace(START_MARK, "<mark>").replace(STOP_MARK, "</mark>")
+        )
+
+
+def strip_html(html: str | None) -> str:
+    # CKEditor HTML -> plain text for the index
+    if not html:
+        return ""
+    # bs4 is only needed once something is written, keep it off the import path
+    from bs4 import BeautifulSoup
+    return " ".join(BeautifulSoup(html, "html.parser").get_text(" ").split())
+
+
+# Indexed from the sanitized body_html (content.apply_post/apply_comment run first), so nothing the
+# pages don't show - script and style text included - can match or turn up in a snippet
+def post_params(post) -> dict:
+    return {"id": post.id, "title": post.title, "subtitle": post.subtitle, "body": strip_html(post.body_html)}
+
+
+def comment_params(comment) -> dict:
+    return {"id": comment.id, "post_id": comment.post_id, "body": strip_html(comment.body_html)}
+
+
+class SqliteSearch:
+    def create(self, conn):
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_search "
+            "USING fts5(title, subtitle, body, tokenize='porter unicode61')"
+        ))
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS comment_search "
+            "USING fts5(post_id UNINDEXED, body, tokenize='porter unicode61')"
+        ))
+
+    def index_post(self, conn, post):
+        self.index_posts(conn, [post])
+
+    def index_posts(self, conn, posts):
+        conn.execute(
+            text("INSERT OR REPLACE INTO post_search (rowid, title, subtitle, body) "
+                 "VALUES (:id, :title, :subtitle, :body)"),
+            [post_params(post) for post in posts]
+        )
+
+    def index_comment(self, conn, comment):
+        self.index_comments(conn, [comment])
+
+    def index_comments(self, conn, comments):
+        conn.execute(
+            text("INSERT OR REPLACE INTO comment_search (rowid, post_id, body) VALUES (:id, :post_id, :body)"),
+            [comment_params(comment) for comment in comments]
+        )
+
+    def remove_post(self, conn, post_id):
+        # Run before the comments themselves are deleted - their ids come from comments.post_id
+        conn.execute(
+            text("DELETE FROM comment_search WHERE rowid IN (SELECT id FROM comments WHERE post_id = :id)"),
+            {"id": post_id}
+        )
+        conn.execute(text("DELETE FROM post_search WHERE rowid = :id"), {"id": post_id})
+
+    @staticmethod
+    def match_query(query: str) -> str | None:
+        # Quote every word so user input can't break the FTS5 syntax, prefix-match the last one
+        words = re.findall(r"\w+", query)
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, conn, query: str, limit: int = 20) -> list[SearchHit]:
+        match = self.match_query(query)
+        if match is None:
+            return []
+        # Rank first, snippets only for the rows that make the page - snippet() on every match is
+        # most of the cost. Title matches count most, comment matches least. The bare row_id next to
+        # MIN() is the best row of each post, MATERIALIZED keeps bm25() out of the aggregates.
+        best = conn.execute(
+            text(
+                "WITH post_hits AS MATERIALIZED ("
+                "  SELECT rowid AS post_id, 'post' AS source, rowid AS row_id, "
+                "         bm25(post_search, 10.0, 5.0, 1.0) AS score "
+                "  FROM post_search WHERE post_search MATCH :match ORDER BY score LIMIT :limit"
+                "), comment_matches AS MATERIALIZED ("
+                "  SELECT CAST(post_id AS INTEGER) AS post_id, rowid AS row_id, bm25(comment_search) * 0.5 AS score "
+                "  FROM comment_search WHERE comment_search MATCH :match"
+                "), comment_hits AS ("
+                "  SELECT post_id, 'comment' AS source, row_id, MIN(score) AS score "
+                "  FROM comment_matches GROUP BY post_id ORDER BY score LIMIT :limit"
+                ") "
+                "SELECT post_id, source, row_id, MIN(score) AS score FROM ("
+                "  SELECT * FROM post_hits UNION ALL SELECT * FROM comment_hits"
+                ") GROUP BY post_id ORDER BY score LIMIT :limit"
+            ),
+            {"match": match, "limit": limit}
+        ).all()
+        if not best:
+            return []
+
+        # One query for both tables - snippet() needs the MATCH, the rowid lists keep it to the chosen rows
+        snippets = {
+            (source, row_id): snippet for source, row_id, snippet in conn.execute(
+                text(
+                    "SELECT 'post', rowid, snippet(post_search, -1, :start, :stop, '...', 24) FROM post_search "
+                    "WHERE post_search MATCH :match AND rowid IN :post_ids "
+                    "UNION ALL "
+                    "SELECT 'comment', rowid, snippet(comment_search, 1, :start, :stop, '...', 24) FROM comment_search "
+                    "WHERE comment_search MATCH :match AND rowid IN :comment_ids"
+                ).bindparams(bindparam("post_ids", expanding=True), bindparam("comment_ids", expanding=True)),
+                {
+                    "match": match, "start": START_MARK, "stop": STOP_MARK,
+                    "post_ids": [row_id for _, source, row_id, _ in best if source == "post"],
+                    "comment_ids": [row_id for _, source, row_id, _ in best if source == "comment"],
+                }
+            )
+        }
+        return [
+            SearchHit(post_id, score, snippets.get((source, row_id), ""))
+            for post_id, source, row_id, score in best
+        ]
+
+
+class PostgresSearch:
+    post_document = (
+        "setweight(to_tsvector('english', :title), 'A') || "
+        "setweight(to_tsvector('english', :subtitle), 'B') || "
+        "setweight(to_tsvector('english', :body), 'D')"
+    )
+
+    def create(self, conn):
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS post_search ("
+            "post_id INTEGER PRIMARY KEY, body_text TEXT NOT NULL, document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS comment_search ("
+            "comment_id INTEGER PRIMARY KEY, post_id INTEGER NOT NULL, "
+            "body_text TEXT NOT NULL, document TSVECTOR NOT NULL)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_search_document ON post_search USING GIN (document)"))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_comment_search_document ON comment_search USING GIN (document)"
+        ))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comment_search_post_id ON comment_search (post_id)"))
+
+    def index_post(self, conn, post):
+        self.index_posts(conn, [post])
+
+    def index_posts(self, conn, posts):
+        conn.execute(
+            text(
+                f"INSERT INTO post_search (post_id, body_text, document) VALUES (:id, :body, {self.post_document}) "
+                f"ON CONFLICT (post_id) DO UPDATE SET body_text = EXCLUDED.body_text, document = EXCLUDED.document"
+            ),
+            [post_params(post) for post in posts]
+        )
+
+    def index_comment(self, conn, comment):
+        self.index_comments(conn, [comment])
+
+    def index_comments(self, conn, comments):
+        conn.execute(
+            text(
+                "INSERT INTO comment_search (comment_id, post_id, body_text, document) "
+                "VALUES (:id, :post_id, :body, to_tsvector('english', :body)) "
+                "ON CONFLICT (comment_id) DO UPDATE SET body_text = EXCLUDED.body_text, document = EXCLUDED.document"
+            ),
+            [comment_params(comment) for comment in comments]
+        )
+
+    def remove_post(self, conn, post_id):
+        conn.execute(text("DELETE FROM comment_search WHERE post_id = :id"), {"id": post_id})
+        conn.execute(text("DELETE FROM post_search WHERE post_id = :id"), {"id": post_id})
+
+    def search(self, conn, query: str, limit: int = 20) -> list[SearchHit]:
+        if not query.strip():
+            return []
+        # Rank first, then build headlines only for the rows that made the cut
+        rows = conn.execute(
+            text(
+                "WITH q AS (SELECT websearch_to_tsquery('english', :query) AS query), "
+                "hits AS ("
+                "  SELECT p.post_id, ts_rank(p.document, q.query) AS rank, p.body_text FROM post_search p, q "
+                "  WHERE p.document @@ q.query "
+                "  UNION ALL "
+                "  SELECT c.post_id, ts_rank(c.document, q.query) * 0.5, c.body_text FROM comment_search c, q "
+                "  WHERE c.document @@ q.query"
+                "), "
+                "best AS ("
+                "  SELECT post_id, rank, body_text FROM ("
+                "    SELECT DISTINCT ON (post_id) post_id, rank, body_text FROM hits ORDER BY post_id, rank DESC"
+                "  ) ranked ORDER BY rank DESC LIMIT :limit"
+                ") "
+                "SELECT best.post_id, best.rank, ts_headline('english', best.body_text, q.query, :options) "
+                "FROM best, q ORDER BY best.rank DESC"
+            ),
+            {
+                "query": query,
+                "limit": limit,
+                "options": f"StartSel={START_MARK}, StopSel={STOP_MARK}, MaxWords=30, MinWords=10, MaxFragments=1"
+            }
+        ).all()
+        return [SearchHit(post_id, rank, snippet) for post_id, rank, snippet in rows]
+
+
+def search_backend(dialect_name: str):
+    if dialect_name == "postgresql":
+        return PostgresSearch()
+    if dialect_name == "sqlite":
+        return SqliteSearch()
+    raise ValueError(f"No full-text search backend for {dialect_name}")
+
+
+def rebuild(backend, conn):
+    # Full build for rows written before search existed, or after they were all re-rendered
+    backend.create(conn)
+    # Only the indexed columns, they are all there is in the index
+    posts_table, comments_table = BlogPosts.__table__, Comment.__table__
+    posts = conn.execute(
+        select(posts_table.c.id, posts_table.c.title, posts_table.c.subtitle, posts_table.c.body_html)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    # One executemany per batch rather than a statement per row
+    for batch in posts.partitions():
+        backend.index_posts(conn, batch)
+    comments = conn.execute(
+        select(comments_table.c.id, comments_table.c.post_id, comments_table.c.body_html)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    for batch in comments.partitions():
+        backend.index_comments(conn, batch)
@@ -1,33 +1,44 @@
 from __future__ import annotations
 import hashlib
-from urllib.parse import urlencode
-from os import environ
-from typing import List
-from datetime import datetime, timedelta
-
-import geocoder
-import sqlalchemy.exc
-from bs4.diagnose import profile
-from flask import Flask, render_template, request, redirect, url_for, flash, abort
+import logging
+import os
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import click
+from flask import (
+    Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, abort, jsonify, send_file,
+    make_response
+)
 from flask_bootstrap import Bootstrap5
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
-import os
-import smtplib
-from flask import Flask
 from flask_wtf.csrf import CSRFProtect
 from flask_ckeditor import CKEditor
-from jwt.utils import force_bytes
-from sqlalchemy.exc import IntegrityError
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user, LoginManager, login_required, current_user, logout_user
+from sqlalchemy import exc
+from sqlalchemy.orm import defer, joinedload, raiseload
 from forms import NewPost, LoginForm, RegisterForm, CommentForm, ContactForm, LocationSubmit, BioForm, ProfileEdit
-from database import db, User, BlogPosts, Comment
-import requests
-from random import randint
-from sqlalchemy import exc, insert, text, create_engine
-import time
-import psycopg2
-import geopy
+from database import db, User, BlogPosts, Comment, OutboxMessage, configure_engines, setup_engines, read_replica
+from cache import make_cache
+from news_weather import NewsWeatherRefresher
+from outbound import HttpClient
+from thumbnails import DiskCache, HttpImageFetcher, ImageProxy, ThumbnailError, MIMETYPE, check_address
+from instrumentation import Instrumentation
+from geocache import GeocodeCache
+from pagination import keyset_page
+from query_budget import query_budget, report_query_count
+from migrations import upgrade
+import content
+import counters
+import feeds
+from search import rebuild as rebuild_search, search_backend
+import transfer
+from page_cache import PageCache
+from mailer import MailWorker, SMTPTransport
+from user_cache import UserCache
+from passwords import PasswordHasher, HashingOverloaded
+from rate_limit import RateLimiter, make_limits
 
 # Load environment vars
 load_dotenv()
@@ -37,160 +48,469 @@ EMAIL = os.environ.get("EMAIL")
 SECRET_KEY = os.environ.get("WTF_CSRF_SECRET_KEY")
 NEWS_API_KEY = os.environ.get("NEWS_API_KEY")
 OW_API_KEY = os.environ.get("OW_API_KEY")
-HOST = "smtp.gmail.com"
+HOST = os.environ.get("MAIL_HOST", "smtp.gmail.com")
+MAIL_PORT = int(os.environ.get("MAIL_PORT", 587))
+MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS", "1") == "1"
+# Set MAIL_USERNAME to an empty string for servers without auth, e.g. a local debugging server
+MAIL_USERNAME = os.environ.get("MAIL_USERNAME", EMAIL)
+REDIS_URL = os.environ.get("REDIS_URL")
+NEWS_WEATHER_REFRESH_SECONDS = int(os.environ.get("NEWS_WEATHER_REFRESH_SECONDS", 600))
+LOCATION_LOOKUP_WAIT = float(os.environ.get("LOCATION_LOOKUP_WAIT", 3))
+OUTBOUND_DEADLINE_SECONDS = float(os.environ.get("OUTBOUND_DEADLINE_SECONDS", 10))
+POSTS_PER_PAGE = int(os.environ.get("POSTS_PER_PAGE", 10))
+MAX_POSTS_PER_PAGE = 50
+COMMENTS_PER_PAGE = int(os.environ.get("COMMENTS_PER_PAGE", 20))
+# gunicorn worker processes (Heroku sets it). Without Redis every worker has its own caches and an
+# invalidation only reaches the worker that wrote - the others serve old users and pages until they
+# expire, so those TTLs are kept short
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+SHARED_CACHES = bool(REDIS_URL) or WEB_CONCURRENCY <= 1
+LOCAL_CACHE_SECONDS = 5
+PAGE_CACHE_SECONDS = int(os.environ.get("PAGE_CACHE_SECONDS", 300 if SHARED_CACHES else LOCAL_CACHE_SECONDS))
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 2048))
+USER_CACHE_SECONDS = int(os.environ.get("USER_CACHE_SECONDS", 300 if SHARED_CACHES else LOCAL_CACHE_SECONDS))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", 16))
+# Request threads per gunicorn worker - the Procfile passes the same value to --threads
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 4))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+# Hashes running plus waiting always leave a thread per worker free for page reads
+PASSWORD_HASH_QUEUE = min(
+    int(os.environ.get("PASSWORD_HASH_QUEUE", 0)), max(0, WEB_THREADS - 1 - PASSWORD_HASH_WORKERS)
+)
+SEARCH_RESULTS = 20
+FEED_POSTS = int(os.environ.get("FEED_POSTS", 20))
+# Feeds are invalidated by tag when posts change, the TTL is only a backstop
+FEED_CACHE_SECONDS = int(os.environ.get("FEED_CACHE_SECONDS", 24 * 3600 if SHARED_CACHES else LOCAL_CACHE_SECONDS))
+# Thumbnail URLs are signed and never change, browsers can keep them
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+# Total time for fetching one source image, redirects and all
+IMAGE_FETCH_SECONDS = float(os.environ.get("IMAGE_FETCH_SECONDS", 5))
+# Token buckets per client (user id, else IP) as "<count>/<second|minute|hour|day>", empty turns one off
+RATE_LIMITS = {
+    "home": os.environ.get("RATE_LIMIT_HOME", "60/minute"),
+    "login": os.environ.get("RATE_LIMIT_LOGIN", "10/minute"),
+    "register": os.environ.get("RATE_LIMIT_REGISTER", "5/hour"),
+    "contact": os.environ.get("RATE_LIMIT_CONTACT", "5/hour"),
+}
+# How many of those expensive requests may run at once - site wide with Redis, otherwise per process,
+# where it has to stay below WEB_THREADS to ever turn anyone away
+EXPENSIVE_CONCURRENCY = int(os.environ.get("EXPENSIVE_CONCURRENCY", 8 if REDIS_URL else max(1, WEB_THREADS // 2)))
+# Proxies in front of the app - client IPs for rate limits come from X-Forwarded-For. Heroku (DYNO is
+# set) always runs the Procfile behind its router, without it every visitor would share one bucket
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 1 if "DYNO" in os.environ else 0))
+# Database engine - see database.ENGINE_DEFAULTS, unset values keep the defaults
+DB_SETTINGS = {
+    key: cast(os.environ[key])
+    for key, cast in [
+        ("DB_POOL_SIZE", int), ("DB_MAX_OVERFLOW", int), ("DB_POOL_TIMEOUT", float), ("DB_POOL_RECYCLE", int),
+        ("DB_POOL_PRE_PING", lambda value: value == "1"), ("DB_STATEMENT_TIMEOUT_MS", int),
+        ("SQLITE_BUSY_TIMEOUT_MS", int), ("SQLITE_MMAP_SIZE", int),
+        ("DB_REPLICA_URI", str), ("DB_REPLICA_PIN_SECONDS", float)
+    ]
+    if os.environ.get(key)
+}
+
+# Extensions - bound to the app in create_app()
+ckeditor = CKEditor()
+csrf = CSRFProtect()
+bootstrap = Bootstrap5()
+login_manager = LoginManager()
+# SQL/render/outbound timings per request - log line, Server-Timing header and /metrics
+instruments = Instrumentation()
+
+# All routes live on this blueprint, cli_group=None keeps the commands at `flask <command>`
+bp = Blueprint("blog", __name__, cli_group=None)
+
+# Logged-in users - their own bounded cache so page entries can't push them out
+users = UserCache()
+users.watch()
+
+# scrypt runs in a bounded process pool instead of on the request worker
+passwords = PasswordHasher()
+
+# Rendered pages for anonymous visitors, dropped by tag when the content they show changes. Their own
+# bounded cache - every distinct query string is an entry and would push news/weather out of the shared one
+page_cache = PageCache()
+
+# Per-client token buckets and the cap on expensive requests - in Redis when REDIS_URL is set
+rate_limiter = RateLimiter()
+
+
+def create_app(config: dict | None = None) -> Flask:
+    app = Flask(__name__)
+
+    # Load DB
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_URI", "sqlite:///posts.db")
+    # Config app for CSFR with a secret key
+    app.config["SECRET_KEY"] = SECRET_KEY
+    app.secret_key = os.environ.get("APP_SECRET_KEY")
+    # X-Query-Count on every response, used by benchmarks/run.py
+    app.config["QUERY_COUNT_HEADER"] = os.environ.get("QUERY_COUNT_HEADER") == "1"
+    app.config["REQUEST_LOG"] = os.environ.get("REQUEST_LOG", "1") == "1"
+    app.config["SERVER_TIMING"] = os.environ.get("SERVER_TIMING", "1") == "1"
+    # Opt-in sampling profiler for requests slower than this many ms
+    app.config["PROFILE_SLOW_REQUESTS_MS"] = os.environ.get("PROFILE_SLOW_REQUESTS_MS")
+    app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR")
+    # Thumbnail cache, defaults to instance/thumbnails. IMAGE_FETCH replaces the HTTP fetcher (url -> bytes)
+    app.config["IMAGE_CACHE_DIR"] = os.environ.get("IMAGE_CACHE_DIR")
+    app.config["IMAGE_CACHE_MB"] = int(os.environ.get("IMAGE_CACHE_MB", 256))
+    app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = os.environ.get("IMAGE_PROXY_ALLOW_PRIVATE") == "1"
+    app.config["IMAGE_FETCH"] = None
+    app.config["RATE_LIMIT_ENABLED"] = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+    app.config["RATE_LIMITS"] = dict(RATE_LIMITS)
+    app.config["EXPENSIVE_CONCURRENCY"] = EXPENSIVE_CONCURRENCY
+    # Caches are in Redis when set so every gunicorn worker sees the same values
+    app.config["REDIS_URL"] = REDIS_URL
+    app.config["PAGE_CACHE_SECONDS"] = PAGE_CACHE_SECONDS
+    app.config["PAGE_CACHE_SIZE"] = PAGE_CACHE_SIZE
+    app.config["USER_CACHE_SECONDS"] = USER_CACHE_SECONDS
+    app.config["USER_CACHE_SIZE"] = USER_CACHE_SIZE
+    app.config["PASSWORD_HASH_METHOD"] = PASSWORD_HASH_METHOD
+    app.config["PASSWORD_SALT_LENGTH"] = PASSWORD_SALT_LENGTH
+    app.config["PASSWORD_HASH_WORKERS"] = PASSWORD_HASH_WORKERS
+    app.config["PASSWORD_HASH_QUEUE"] = PASSWORD_HASH_QUEUE
+    app.config.update(DB_SETTINGS)
+    app.config.update(config or {})
+    configure_engines(app)
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(name)s %(message)s")
+    if not (app.config["REDIS_URL"] or WEB_CONCURRENCY <= 1):
+        app.logger.warning(
+            "%d workers without REDIS_URL - users and pages are cached per worker, only for %ds by default",
+            WEB_CONCURRENCY, LOCAL_CACHE_SECONDS
+        )
 
-app = Flask(__name__)
+    # init app with extensions
+    db.init_app(app)
+    setup_engines(app)
+    ckeditor.init_app(app)
+    csrf.init_app(app)
+    bootstrap.init_app(app)
+    login_manager.init_app(app)
+    instruments.init_app(app)
+    users.init_app(app)
+    passwords.init_app(app)
+    page_cache.init_app(app)
+    rate_limiter.init_app(app)
+    with app.app_context():
+        instruments.watch_engines(db.engines)
+
+    app.register_blueprint(bp)
+    app.after_request(report_query_count)
+
+    # Geocoded locations persist next to posts.db in the instance folder
+    os.makedirs(app.instance_path, exist_ok=True)
+    geocodes = GeocodeCache(os.path.join(app.instance_path, "geocode_cache.db"))
+
+    # Refresh news and weather in the background instead of on every request
+    app.extensions["refresher"] = NewsWeatherRefresher(
+        make_cache(app.config["REDIS_URL"]),
+        # Pooled keep-alive sessions for the news/weather/geocode APIs
+        HttpClient(on_request=instruments.record_outbound),
+        geocodes,
+        news_api_key=NEWS_API_KEY,
+        interval=NEWS_WEATHER_REFRESH_SECONDS,
+        call_deadline=OUTBOUND_DEADLINE_SECONDS,
+        on_update=lambda key: invalidate_news_weather(app)
+    )
 
-# Load ckeditor
-ckeditor = CKEditor(app)
+    # Contact form emails go through the outbox table and a background sender
+    app.extensions["mail_worker"] = MailWorker(
+        app,
+        SMTPTransport(host=HOST, port=MAIL_PORT, username=MAIL_USERNAME, password=PASSWORD, use_tls=MAIL_USE_TLS),
+        from_addr=EMAIL
+    )
 
-# Load DB
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_URI", "sqlite:///posts.db")
+    # Post image and avatar thumbnails for /img
+    allow_private = app.config["IMAGE_PROXY_ALLOW_PRIVATE"]
+    fetch = app.config["IMAGE_FETCH"] or HttpImageFetcher(
+        HttpClient(on_request=instruments.record_outbound, check_address=None if allow_private else check_address),
+        allow_private=allow_private,
+        deadline_seconds=IMAGE_FETCH_SECONDS
+    )
+    app.extensions["image_proxy"] = ImageProxy(
+        DiskCache(
+            app.config["IMAGE_CACHE_DIR"] or os.path.join(app.instance_path, "thumbnails"),
+            max_bytes=app.config["IMAGE_CACHE_MB"] * 1024 * 1024
+        ),
+        fetch,
+        secret=app.secret_key
+    )
 
-# init app with extension
-db.init_app(app)
+    # Full-text index - FTS5 on SQLite, tsvector + GIN on Postgres
+    with app.app_context():
+        app.extensions["search_index"] = search_backend(db.engine.dialect.name)
 
-# Create the db tables
-with app.app_context():
-    db.create_all()
+    return app
 
 
-# Enable CSRF for flask forms
-csrf = CSRFProtect(app)
-# Config app for CSFR with a secret key
-app.config["SECRET_KEY"] = SECRET_KEY
-app.secret_key = os.environ.get("APP_SECRET_KEY")
+def invalidate_news_weather(app):
+    # Runs on the refresher thread, page_cache finds this app's cache through the app context
+    with app.app_context():
+        page_cache.invalidate("news-weather")
 
-# Load bootstrap
-bootstrap = Bootstrap5(app)
 
-# Load login manager
-login_manager = LoginManager()
-login_manager.init_app(app)
+def search_index():
+    return current_app.extensions["search_index"]
 
-# # Admin decorator - make a decorator instead of adding or current_user.id == 1 to functions
-# def admin_only():
-#     def inner():
-#         if current_user.id == 1:
-#     return inner
 
-def api_calls(location):
-    # TODO: Periodically call the News and Weather API for updates, cache the updates instead of calling on routes
-    # Call news API for current headlines
-    news_endpoint = "https://newsapi.org/v2/top-headlines"
-    news_params = {
-        "apiKey": NEWS_API_KEY,
-        "pageSize": 10,
-        "country": "us"
-    }
+def image_proxy():
+    return current_app.extensions["image_proxy"]
 
-    news_request = requests.get(news_endpoint, params=news_params)
-    news_data = news_request.json()
 
-    print(news_data)
-    news_articles = news_data["articles"]
+@bp.app_template_filter("rfc3339")
+def rfc3339(value):
+    return feeds.timestamp(value)
 
-    # Call Weather API for current weather
-    # First get user location - lat and long to find forecast
-    # TODO: DRY up the weather logic and make it flow better
 
-    weather_endpoint = ""
+@bp.app_template_global()
+def thumbnail(url, size):
+    # Signed /img URL for a remote image, local and empty URLs are left alone
+    if not url or urlsplit(url).scheme not in ("http", "https"):
+        return url
+    return url_for("blog.get_thumbnail", size=size, url=url, sig=image_proxy().sign(size, url))
 
-    if request.method == "GET":
-        # Initially grab weather based on server's location
-        user_coords = geocoder.ip("me")
-        # Weather based on server
-        weather_endpoint = f"https://api.weather.gov/points/{user_coords.lat},{user_coords.lng}"
 
-    if location.validate_on_submit():
-        # Allow user to enter a city/state after initial load
-        try:
-            # Geolocation - NOM API Call
-            nom = geopy.geocoders.Nominatim(user_agent="blogger_app")
-            user_coords = nom.geocode(
-                query=f"{location.data.get('location')}",
-                addressdetails=True,
-                geometry="geojson",
-                extratags=True
-            )
-        except requests.exceptions.MissingSchema:
-            # If API call failed - default back to server's location
-            user_coords = geocoder.ip("me")
-            # Weather based on server
-            weather_endpoint = f"https://api.weather.gov/points/{user_coords.lat},{user_coords.lng}"
-        else:
-            if user_coords is not None:
-                print("Location found")
-                weather_endpoint = f"https://api.weather.gov/points/{user_coords.latitude},{user_coords.longitude}"
-            else:
-                # If API call is successful but location is invalid - default back to server's location
-                user_coords = geocoder.ip("me")
-                # Weather based on server
-                weather_endpoint = f"https://api.weather.gov/points/{user_coords.lat},{user_coords.lng}"
+@bp.before_app_request
+def start_background_workers():
+    # Started by the first request, not create_app(), so CLI commands don't spin up threads
+    current_app.extensions["refresher"].start()
+    current_app.extensions["mail_worker"].start()
+
+
+@bp.cli.command("init-db")
+def init_db():
+    """Create the database tables and the search index."""
+    db.create_all()
+    with db.engine.begin() as conn:
+        search_index().create(conn)
+    print("Database created")
+
+
+@bp.cli.command("repair-counts")
+def repair_counts():
+    """Recompute the post and comment counters from the real rows."""
+    with db.engine.begin() as conn:
+        fixed = counters.repair(conn)
+    print(f"Fixed post counts of {fixed['users']} users and comment counts of {fixed['posts']} posts")
+
+
+@bp.cli.command("render-content")
+@click.option("--all", "everything", is_flag=True, help="Re-render every row, not just the missing ones.")
+def render_content(everything):
+    """Sanitize post and comment HTML, store excerpts and reading times and re-index them."""
+    with db.engine.begin() as conn:
+        rendered = content.backfill(conn, everything)
+        if rendered["posts"] or rendered["comments"]:
+            # The search index is built from body_html
+            rebuild_search(search_index(), conn)
+    print(f"Rendered {rendered['posts']} posts and {rendered['comments']} comments")
+
+
+def progress_printer():
+    # One line per table, rewritten in place as batches go by
+    current = []
+
+    def progress(table, rows):
+        if current and current[0] != table:
+            click.echo(err=True)
+        current[:] = [table]
+        click.echo(f"\r{table}: {rows} rows", nl=False, err=True)
+    return progress
+
+
+@bp.cli.command("export-blog")
+@click.argument("path")
+def export_blog(path):
+    """Stream users, posts and comments to a gzipped JSON-lines archive."""
+    with db.engine.connect() as conn:
+        counts = transfer.export_archive(conn, path, progress=progress_printer())
+    click.echo(err=True)
+    print(f"Exported {counts} to {path}")
+
+
+@bp.cli.command("import-blog")
+@click.argument("path")
+def import_blog(path):
+    """Load an export-blog archive into an empty database."""
+    db.create_all()
+    try:
+        with db.engine.begin() as conn:
+            counts = transfer.import_archive(conn, path, search_index(), progress=progress_printer())
+    except (OSError, ValueError) as error:
+        raise click.ClickException(str(error))
+    click.echo(err=True)
+    print(f"Imported {counts} from {path}")
+
 
-    # Make Weather API request and output the data
-    weather_request = requests.get(weather_endpoint)
-    weather_data = weather_request.json()
-    print(weather_data)
+@bp.cli.command("upgrade-db")
+def upgrade_db():
+    """Add new columns and indexes to an existing database and backfill them."""
+    upgrade()
+    print("Database upgraded")
 
-    location_details = weather_data["properties"]["relativeLocation"]["properties"]
-    city = location_details["city"]
-    state = location_details["state"]
 
-    # Endpoint for forecast based on previous call for weather location
-    forecast_endpoint = weather_data["properties"]["forecast"]
+# # Admin decorator - make a decorator instead of adding or current_user.id == 1 to functions
+# def admin_only():
+#     def inner():
+#         if current_user.id == 1:
+#     return inner
+
+def api_calls(location):
+    # News and weather are refreshed in the background - only read the cached values here
+    city = None
+
+    if location.validate_on_submit():
+        # Allow user to enter a city/state after initial load
+        city = location.data.get("location")
 
-    forecast_request = requests.get(forecast_endpoint)
-    forecast_data = forecast_request.json()
+    refresher = current_app.extensions["refresher"]
+    news_articles, news_updated_at = refresher.news()
+    forecast, weather_updated_at = refresher.forecast(city, wait=LOCATION_LOOKUP_WAIT)
 
-    print(location_details)
+    if forecast is None and city is not None:
+        # Location is invalid or not fetched yet - default back to server's location
+        flash("Could not find weather for that location, showing the server's location instead.")
+        forecast, weather_updated_at = refresher.forecast()
 
-    forecast_data_by_day = forecast_data["properties"]["periods"]
+    if forecast is None:
+        forecast = {"weather": [], "location": {"city": None, "state": None}}
 
-    # Combine data from both api calls
-    # TODO: Consider breaking these API calls out into separate function calls possibly
+    # Combine the cached data, updated_at is the oldest of the two values shown
+    updated_at = min((stamp for stamp in (news_updated_at, weather_updated_at) if stamp is not None), default=None)
     api_data = {
-        "news": news_articles,
-        "weather": forecast_data_by_day,
-        "location": {
-            "city": city,
-            "state": state
-        },
-        "updated_at": datetime.now()
+        "news": news_articles or [],
+        "weather": forecast["weather"],
+        "location": forecast["location"],
+        "updated_at": updated_at
     }
 
-    print(api_data)
     return api_data
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    # None logs the session out if the user no longer exists
+    return users.get(user_id)
+
+# Listings show the stored excerpt - bodies stay in the database
+SKIP_BODIES = (
+    defer(BlogPosts.body, raiseload=True),
+    defer(BlogPosts.body_html, raiseload=True),
+    defer(BlogPosts.image_urls, raiseload=True),
+)
+
+def posts_page():
+    # Newest posts first, ?before=<id> / ?after=<id> move between pages
+    page_size = min(request.args.get("per_page", POSTS_PER_PAGE, type=int), MAX_POSTS_PER_PAGE)
+    return keyset_page(
+        # Authors come in the same query, comments are never shown on listings
+        db.select(BlogPosts).options(
+            joinedload(BlogPosts.author), raiseload(BlogPosts.post_comments), *SKIP_BODIES
+        ),
+        BlogPosts.id,
+        page_size=max(page_size, 1),
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int)
+    )
+
+def comments_page(post_id, before=None):
+    # Newest comments first, ?before=<comment id> for older ones - authors come in the same query
+    return keyset_page(
+        db.select(Comment).where(Comment.post_id == post_id)
+        .options(joinedload(Comment.author), defer(Comment.comment_body, raiseload=True)),
+        Comment.id,
+        page_size=COMMENTS_PER_PAGE,
+        before=before
+    )
+
+def tag_comments(post_id, page, first_page):
+    # Older pages never change when someone comments, only the first page carries comments:<id>
+    page_cache.tag(f"post:{post_id}", *(f"user:{comment.author_id}" for comment in page.items))
+    if first_page:
+        page_cache.tag(f"comments:{post_id}")
+
+def tag_posts(posts):
+    # Listing pages change when any listed post or its author's byline changes
+    page_cache.tag(*(f"post:{post.id}" for post in posts), *(f"user:{post.author_id}" for post in posts))
 
 # Post Routes
-@app.route("/", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
+@page_cache.cached()
+# Below the page cache - cached pages are cheap and don't count
+@rate_limiter.limit("home", expensive=True)
+@query_budget(2)
+@read_replica
 def get_blog():
-    all_blog_posts = db.session.execute(db.select(BlogPosts)).scalars().all()
+    page = posts_page()
+    page_cache.tag("posts", "news-weather")
+    tag_posts(page.items)
 
     location_form = LocationSubmit()
 
     api_results = api_calls(location_form)
 
-    print(api_results)
-
     return render_template(
         template_name_or_list="index.html",
-        posts=all_blog_posts,
+        posts=page.items,
+        page=page,
         news=api_results["news"],
         forecast=api_results["weather"],
         location=api_results["location"],
+        updated_at=api_results["updated_at"],
         form=location_form
     )
 
 
-@app.route(rule="/posts/<post_id>", methods=["GET", "POST"])
+@bp.route("/posts.json")
+@page_cache.cached()
+@query_budget(2)
+@read_replica
+def get_blog_json():
+    # Same listing as the home page, without the news and weather
+    page = posts_page()
+    page_cache.tag("posts")
+    tag_posts(page.items)
+    return jsonify(
+        posts=[
+            {
+                "id": post.id,
+                "title": post.title,
+                "subtitle": post.subtitle,
+                "excerpt": post.excerpt,
+                "reading_minutes": post.reading_minutes,
+                "date": post.date,
+                "img_url": post.img_url,
+                "comment_count": post.comment_count,
+                "author": {"id": post.author_id, "username": post.author.username},
+                "url": url_for("blog.get_blog_post", post_id=post.id, _external=True)
+            }
+            for post in page.items
+        ],
+        next=url_for("blog.get_blog_json", before=page.next_cursor, per_page=request.args.get("per_page"))
+        if page.next_cursor else None,
+        prev=url_for("blog.get_blog_json", after=page.prev_cursor, per_page=request.args.get("per_page"))
+        if page.prev_cursor else None
+    )
+
+
+@bp.route(rule="/posts/<post_id>", methods=["GET", "POST"])
+@page_cache.cached()
+@query_budget(5)
+@read_replica
 def get_blog_post(post_id):
-    # Get post
-    post_to_display = db.get_or_404(BlogPosts, post_id)
+    # Get post with its author, comments are paged in separately so big threads cost the same.
+    # The page shows the stored body_html, the editor source isn't needed
+    post_to_display = db.first_or_404(
+        db.select(BlogPosts)
+        .where(BlogPosts.id == post_id)
+        .options(
+            joinedload(BlogPosts.author), raiseload(BlogPosts.post_comments), defer(BlogPosts.body, raiseload=True)
+        )
+    )
 
     # Add Comments to post
     comment_form = CommentForm()
@@ -202,23 +522,132 @@ def get_blog_post(post_id):
                 post_id=post_id,
                 comment_body=comment_form.data.get("comment")
             )
+            content.apply_comment(new_comment)
 
             db.session.add(new_comment)
+            db.session.flush()
+            search_index().index_comment(db.session, new_comment)
+            counters.change_comment_count(db.session, post_to_display.id, 1)
+            # Only the post page shows comments, listings tagged post:<id> stay cached and
+            # catch up on comment_count when they expire
+            comments_tag = f"comments:{post_to_display.id}"
             db.session.commit()
+            page_cache.invalidate(comments_tag)
             flash("Comment added!")
-            return redirect(url_for("get_blog_post", post_id=post_id))
+            return redirect(url_for("blog.get_blog_post", post_id=post_id))
         else:
             flash("Please Login to comment!")
-            return redirect(url_for("login_form"))
+            return redirect(url_for("blog.login_form"))
+
+    # First page of comments is rendered with the post, the rest come from get_comments
+    comments = comments_page(post_to_display.id)
+    page_cache.tag(f"user:{post_to_display.author_id}")
+    tag_comments(post_to_display.id, comments, first_page=True)
 
     return render_template(
         template_name_or_list="post.html",
         post=post_to_display,
+        comments=comments,
         comment_form=comment_form,
     )
 
 
-@app.route("/new-post", methods=["GET", "POST"])
+def feed_posts(author_id=None):
+    # Latest posts with their authors, everything but the raw editor source
+    query = db.select(BlogPosts).options(
+        joinedload(BlogPosts.author),
+        raiseload(BlogPosts.post_comments),
+        defer(BlogPosts.body, raiseload=True),
+        defer(BlogPosts.image_urls, raiseload=True)
+    )
+    if author_id is None:
+        query = query.order_by(BlogPosts.id.desc())
+    else:
+        query = query.where(BlogPosts.author_id == author_id).order_by(BlogPosts.created_at.desc())
+    posts = db.session.execute(query.limit(FEED_POSTS)).scalars().all()
+    page_cache.tag(*(f"post:{post.id}" for post in posts), *(f"user:{post.author_id}" for post in posts))
+    return posts
+
+
+def render_feed(kind, title, home_url, feed_url, posts):
+    if kind == "json":
+        response = jsonify(feeds.json_feed(title, home_url, feed_url, posts))
+        response.mimetype = "application/feed+json"
+        return response
+    response = make_response(render_template(
+        "feed.xml", title=title, home_url=home_url, feed_url=feed_url, posts=posts, updated=feeds.updated(posts)
+    ))
+    response.mimetype = "application/atom+xml"
+    return response
+
+
+@bp.route("/feed.<any(xml, json):kind>")
+@page_cache.cached(ttl=FEED_CACHE_SECONDS, shared=True, etag=True)
+@query_budget(1)
+@read_replica
+def get_feed(kind):
+    # Never touches the news/weather code - readers polling this cost a cache lookup
+    page_cache.tag("posts")
+    return render_feed(
+        kind,
+        "Bloggin'",
+        url_for("blog.get_blog", _external=True),
+        url_for("blog.get_feed", kind=kind, _external=True),
+        feed_posts()
+    )
+
+
+@bp.route("/profile/<int:user_id>/feed.<any(xml, json):kind>")
+@page_cache.cached(ttl=FEED_CACHE_SECONDS, shared=True, etag=True)
+@query_budget(2)
+@read_replica
+def get_author_feed(user_id, kind):
+    author = db.get_or_404(User, user_id)
+    page_cache.tag(f"profile:{author.id}", f"user:{author.id}")
+    return render_feed(
+        kind,
+        f"{author.username} on Bloggin'",
+        url_for("blog.get_profile", user_id=author.id, _external=True),
+        url_for("blog.get_author_feed", user_id=author.id, kind=kind, _external=True),
+        feed_posts(author.id)
+    )
+
+
+@bp.route("/posts/<int:post_id>/comments")
+@page_cache.cached()
+@query_budget(2)
+@read_replica
+def get_comments(post_id):
+    # Older comments for "Load older comments" - an HTML fragment, or JSON with ?format=json
+    before = request.args.get("before", type=int)
+    page = comments_page(post_id, before)
+    tag_comments(post_id, page, first_page=before is None)
+    next_url = None
+    if page.next_cursor:
+        next_url = url_for(
+            "blog.get_comments", post_id=post_id, before=page.next_cursor, format=request.args.get("format")
+        )
+
+    if request.args.get("format") == "json":
+        return jsonify(
+            comments=[
+                {
+                    "id": comment.id,
+                    "author": {
+                        "id": comment.author_id,
+                        "username": comment.author.username,
+                        "profile_pic": comment.author.profile_pic
+                    },
+                    "body": comment.body_html
+                }
+                for comment in page.items
+            ],
+            next=next_url
+        )
+    return render_template("comments.html", post_id=post_id, comments=page)
+
+
+@bp.route("/new-post", methods=["GET", "POST"])
 @login_required
 def new_post():
     form = NewPost()
@@ -228,25 +657,33 @@ def new_post():
             author_id=current_user.id,
             title=form.data.get("title"),
             date=datetime.now().strftime("%B %w, %Y"),
+            created_at=datetime.now(),
             body=form.data.get("body"),
             img_url=form.data.get("img_url"),
             subtitle=form.data.get("subtitle")
         )
+        content.apply_post(post)
 
         try:
             db.session.add(post)
+            # Flush for the new id, the search index row goes in the same transaction
+            db.session.flush()
+            search_index().index_post(db.session, post)
+            counters.change_post_count(db.session, post.author_id, 1)
             db.session.commit()
         except db.exc.IntegrityError:
+            db.session.rollback()
             # Add flash
             flash("Post with this title Exists")
-            return redirect(url_for("get_blog"))
+            return redirect(url_for("blog.get_blog"))
         else:
-            return redirect(url_for("get_blog"))
+            page_cache.invalidate("posts", f"profile:{post.author_id}")
+            return redirect(url_for("blog.get_blog"))
 
     return render_template("forms.html", form=form)
 
 
-@app.route("/edit-post/<post_id>", methods=["GET", "POST"])
+@bp.route("/edit-post/<post_id>", methods=["GET", "POST"])
 @login_required
 def edit_post(post_id):
     post_to_edit = db.get_or_404(BlogPosts, post_id)
@@ -264,11 +701,14 @@ def edit_post(post_id):
         if edit_form.validate_on_submit():
             post_to_edit.title = edit_form.data.get("title")
             post_to_edit.body = edit_form.data.get("body")
+            content.apply_post(post_to_edit)
             post_to_edit.img_url = edit_form.data.get("img_url")
             post_to_edit.subtitle = edit_form.data.get("subtitle")
 
+            search_index().index_post(db.session, post_to_edit)
             db.session.commit()
-            return redirect(url_for("get_blog_post", post_id=post_to_edit.id))
+            page_cache.invalidate(f"post:{post_to_edit.id}")
+            return redirect(url_for("blog.get_blog_post", post_id=post_to_edit.id))
 
         return render_template("forms.html", form=edit_form, post_id=post_to_edit.id)
     else:
@@ -276,24 +716,72 @@ def edit_post(post_id):
         abort(403)
 
 
-@app.route("/delete/<post_id>", methods=["GET"])
+@bp.route("/delete/<post_id>", methods=["GET"])
 @login_required
 def delete_post(post_id):
     # Delete the blogpost AND comments associated with blogpost
     # Get post author id and confirm logged-in user is the author before deleting
     post = db.get_or_404(BlogPosts, post_id)
     if current_user.is_authenticated and current_user.id == post.author.id or current_user.id == 1:
+        # The row is gone after commit, keep the author for the counter and cache tags
+        author_id = post.author_id
+        search_index().remove_post(db.session, post_id)
         db.session.execute(db.delete(Comment).where(Comment.post_id == post_id))
         db.session.execute(db.delete(BlogPosts).where(BlogPosts.id == post_id))
+        counters.change_post_count(db.session, author_id, -1)
         db.session.commit()
+        page_cache.invalidate(f"post:{post_id}", "posts", f"profile:{author_id}")
     else:
         # If user is not the post's author, return forbidden
         abort(403)
-    return redirect(url_for("get_blog"))
+    return redirect(url_for("blog.get_blog"))
+
+
+@bp.route("/img/<size>")
+def get_thumbnail(size):
+    url = request.args.get("url", "")
+    if not image_proxy().verify(size, url, request.args.get("sig")):
+        abort(404)
+    try:
+        path, key = image_proxy().thumbnail(size, url)
+    except ThumbnailError as error:
+        # Better the full-size original than a broken image - only for a while, it may come back
+        current_app.logger.info("%s", error)
+        response = redirect(url)
+        response.cache_control.max_age = 300
+        return response
+    response = send_file(path, mimetype=MIMETYPE, etag=key, max_age=THUMBNAIL_MAX_AGE, conditional=True)
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route("/search")
+@query_budget(3)
+def search_posts():
+    query = request.args.get("q", "").strip()
+    hits = search_index().search(db.session, query, limit=SEARCH_RESULTS) if query else []
+
+    # Load the matching posts and their authors in one query, keep the ranked order
+    posts = {}
+    if hits:
+        posts = {
+            post.id: post for post in db.session.execute(
+                db.select(BlogPosts)
+                .where(BlogPosts.id.in_([hit.post_id for hit in hits]))
+                .options(joinedload(BlogPosts.author), raiseload(BlogPosts.post_comments), *SKIP_BODIES)
+            ).scalars()
+        }
+
+    return render_template(
+        "search.html",
+        query=query,
+        results=[(posts[hit.post_id], hit) for hit in hits if hit.post_id in posts]
+    )
 
 
 # Login/User Routes
-@app.route(rule="/login", methods=["GET", "POST"])
+@bp.route(rule="/login", methods=["GET", "POST"])
+@rate_limiter.limit("login", methods=("POST",), expensive=True)
 def login_form():
     form = LoginForm()
 
@@ -303,16 +791,35 @@ def login_form():
     if form.validate_on_submit():
         user = db.session.execute(db.select(User).where(User.email == user_email)).scalar()
         if user is not None:
-            if check_password_hash(user.password, user_password):
+            try:
+                password_ok = passwords.verify(user.password, user_password)
+            except HashingOverloaded:
+                flash("Lots of people are logging in right now, please try again in a moment.")
+                return render_template(template_name_or_list="forms.html", form=form), 503
+
+            if password_ok:
                 login_user(user)
+                # Start the session with a fresh copy of the user
+                users.invalidate(user.id)
+
+                # Upgrade hashes made with older settings while we have the plain password
+                if passwords.needs_rehash(user.password):
+                    try:
+                        user.password = passwords.hash(user_password)
+                    except HashingOverloaded:
+                        pass
 
                 # Check for profile pic - ensures a str value and null is present
-                if type(user.profile_pic) is not str:
+                new_profile_pic = type(user.profile_pic) is not str
+                if new_profile_pic:
                     user.profile_pic = f"https://gravatar.com/avatar/{ user.email_hash }?d=retro&s=40"
+                user_tag = f"user:{user.id}"
 
                 db.session.commit()
+                if new_profile_pic:
+                    page_cache.invalidate(user_tag)
 
-                return redirect(url_for("get_blog"))
+                return redirect(url_for("blog.get_blog"))
         else:
             flash("Invalid email or Password!")
 
@@ -320,24 +827,31 @@ def login_form():
 
     return render_template(template_name_or_list="forms.html", form=form)
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for("get_blog"))
+    return redirect(url_for("blog.get_blog"))
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
+@rate_limiter.limit("register", methods=("POST",), expensive=True)
 def register_user():
     form = RegisterForm()
 
     if form.validate_on_submit():
+        try:
+            password_hash = passwords.hash(form.data.get("password"))
+        except HashingOverloaded:
+            flash("Lots of people are signing up right now, please try again in a moment.")
+            return render_template(template_name_or_list="forms.html", form=form), 503
+
         email_encoded = form.data.get("email").lower().encode('utf-8')
         # Email hash to request an Avatar from Gravatar
         # noinspection PyArgumentList
         new_user = User(
             email=form.data.get("email"),
             email_hash=hashlib.sha256(email_encoded).hexdigest(),
-            password=generate_password_hash(form.data.get("password"), method="scrypt", salt_length=10),
+            password=password_hash,
             username=form.data.get("username")
         )
 
@@ -352,20 +866,31 @@ def register_user():
             flash("User exists with this email!")
         else:
             login_user(new_user)
-            return redirect(url_for("get_blog"))
+            return redirect(url_for("blog.get_blog"))
 
     return render_template(template_name_or_list="forms.html", form=form)
 
 # User Profile routes
-@app.route(rule="/profile/<user_id>", methods=["GET", "POST"])
+@bp.route(rule="/profile/<user_id>", methods=["GET", "POST"])
+@page_cache.cached()
+@query_budget(3)
+@read_replica
 def get_profile(user_id):
-    user_requested = db.session.execute(db.select(User).where(User.id == user_id)).scalar()
+    user_requested = db.first_or_404(db.select(User).where(User.id == user_id))
     # print(user_requested.username)
 
-    # Get user's posts and post count
-    user_posts = db.session.execute(db.select(BlogPosts).where(BlogPosts.author_id == user_requested.id)).scalars().all()
+    # Get user's posts - the author is user_requested, already in the session
+    user_posts = db.session.execute(
+        db.select(BlogPosts)
+        .where(BlogPosts.author_id == user_requested.id)
+        .order_by(BlogPosts.created_at.desc())
+        .options(raiseload(BlogPosts.post_comments), *SKIP_BODIES)
+    ).scalars().all()
     # print(user_posts)
-    post_count = len(user_posts)
+    # Kept up to date by new_post/delete_post, no need to count the rows
+    post_count = user_requested.post_count
+
+    page_cache.tag(f"user:{user_requested.id}", f"profile:{user_requested.id}", *(f"post:{post.id}" for post in user_posts))
 
     # # User options
     # # Set bio
@@ -383,7 +908,7 @@ def get_profile(user_id):
                            # bio_form=bio_form
                            )
 
-@app.route(rule="/profile/<user_id>/edit-profile", methods=["POST", "GET"])
+@bp.route(rule="/profile/<user_id>/edit-profile", methods=["POST", "GET"])
 @login_required
 def edit_profile(user_id):
     # user_requested = db.session.execute(db.select(User).where(User.id == user_id)).scalar()
@@ -417,46 +942,48 @@ def edit_profile(user_id):
                 flash("Username or email already taken!")
                 # Add rollback for if db entry fails
                 db.session.rollback()
-                redirect(url_for("edit_profile", user_id=user_id))
+                redirect(url_for("blog.edit_profile", user_id=user_id))
             else:
+                # Drops the profile and every cached page with this user's byline
+                users.invalidate(user_requested.id)
+                page_cache.invalidate(f"user:{user_requested.id}")
                 flash("User info changed successfully")
-                return redirect(url_for("get_profile", user_id=user_id))
+                return redirect(url_for("blog.get_profile", user_id=user_id))
 
         return render_template("forms.html", form=profile_edit)
     else:
-        return redirect(url_for("get_blog"))
+        return redirect(url_for("blog.get_blog"))
 
 
 
 
 # Misc routes
-@app.route(rule="/about")
+@bp.route(rule="/about")
 def get_about():
     return render_template("about.html")
 
-@app.route(rule="/contact", methods=["POST", "GET"])
+@bp.route(rule="/contact", methods=["POST", "GET"])
+@rate_limiter.limit("contact", methods=("POST",), expensive=True)
 def contact_page():
     contact_form = ContactForm()
 
     if contact_form.validate_on_submit():
-        email_conn = smtplib.SMTP(host=HOST, port=587)
-        email_conn.starttls()
-        email_conn.login(EMAIL, PASSWORD)
-        email_conn.sendmail(
-            from_addr=EMAIL,
-            to_addrs=EMAIL,
-            msg=f"Subject:Blog Message\n\n "
-                f"Name: {contact_form.data.get('name')}\n "
-                f"Email: {contact_form.data.get('email')}\n "
-                f"Phone: {contact_form.data.get('phone_num')}\n "
-                f"Message: {contact_form.data.get('message')}"
-        )
-        email_conn.quit()
+        # Queue the message - the mail worker sends it in the background
+        db.session.add(OutboxMessage(
+            to_addr=EMAIL,
+            subject="Blog Message",
+            body=f"Name: {contact_form.data.get('name')}\n"
+                 f"Email: {contact_form.data.get('email')}\n"
+                 f"Phone: {contact_form.data.get('phone_num')}\n"
+                 f"Message: {contact_form.data.get('message')}"
+        ))
+        db.session.commit()
+        current_app.extensions["mail_worker"].wake()
         flash("Message Submitted! Thank You!")
-        return redirect(url_for("contact_page"))
+        return redirect(url_for("blog.contact_page"))
 
     return render_template("contact.html", form=contact_form)
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
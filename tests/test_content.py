@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import pytest
+
+import content
+import search
+
+
+@pytest.mark.parametrize("sanitize", [content.sanitize_post, content.sanitize_comment])
+def test_script_and_style_are_dropped_with_their_contents(sanitize):
+    html = "<p>a<script>alert(1)</script>b<STYLE>p { color: red }</STYLE>c</p><script>never closed"
+    assert sanitize(html) == "<p>abc</p>"
+
+
+def test_escaped_tags_stay_text():
+    html = "<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>"
+    assert content.sanitize_post(html) == html
+
+
+def test_other_disallowed_tags_keep_their_text():
+    assert content.sanitize_comment("<p><u>a</u><span>b</span><iframe>c</iframe></p>") == "<p><u>a</u>bc</p>"
+
+
+def test_excerpt_skips_script_text():
+    assert content.render_post("<p>Hello<script>evil()</script> world</p>").excerpt == "Hello world"
+
+
+def test_search_indexes_the_sanitized_html():
+    post = SimpleNamespace(id=1, title="t", subtitle="s", body="<p>Hello<script>secretword()</script> world</p>")
+    comment = SimpleNamespace(id=2, post_id=1, comment_body="<p>Hi<style>.secretword {}</style></p>")
+    content.apply_post(post)
+    content.apply_comment(comment)
+    assert "secretword" not in search.post_params(post)["body"]
+    assert "secretword" not in search.comment_params(comment)["body"]
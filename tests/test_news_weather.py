@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+import news_weather
+from cache import LocalCache
+from geocache import GeocodeCache
+from news_weather import NewsWeatherRefresher
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def geocodes(tmp_path, clock):
+    return GeocodeCache(str(tmp_path / "geocodes.db"), miss_ttl=3600, clock=clock)
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    # Nominatim and weather.gov stand-ins, "springfield" is the only place that exists
+    calls = []
+
+    def geocode(client, location, deadline=None):
+        calls.append(location)
+        return (39.78, -89.65) if location == "springfield" else None
+
+    monkeypatch.setattr(news_weather, "geocode", geocode)
+    monkeypatch.setattr(news_weather, "lookup_point", lambda client, lat, lng, deadline=None: {
+        "lat": lat, "lng": lng, "forecast_url": "https://forecast", "city": "Springfield", "state": "IL"
+    })
+    monkeypatch.setattr(news_weather, "fetch_forecast", lambda client, point, deadline=None: {"weather": []})
+    return calls
+
+
+def test_missing_locations_are_remembered_until_miss_ttl(geocodes, clock):
+    geocodes.set_missing("atlantis")
+    assert geocodes.is_missing("atlantis")
+    assert geocodes.get("atlantis") is None
+    clock.now += 3601
+    assert not geocodes.is_missing("atlantis")
+
+
+def test_unknown_locations_are_geocoded_once_and_never_tracked(geocodes, lookups):
+    refresher = NewsWeatherRefresher(LocalCache(), client=None, geocodes=geocodes)
+
+    for _ in range(3):
+        refresher.refresh_forecast("atlantis")
+    assert lookups == ["atlantis"]
+    assert refresher._tracked_locations() == []
+
+    refresher.refresh_forecast("springfield")
+    assert refresher._tracked_locations() == ["springfield"]
+    assert refresher.forecast("springfield")[0] == {"weather": []}
+
+
+def test_forecast_requests_an_unknown_location_only_once(geocodes, lookups):
+    refresher = NewsWeatherRefresher(LocalCache(), client=None, geocodes=geocodes)
+    for _ in range(3):
+        assert refresher.forecast("Atlantis") == (None, None)
+    assert refresher._pending.qsize() == 1
+    assert refresher._tracked_locations() == []
+
+
+def test_concurrent_starts_run_one_thread(geocodes):
+    refresher = NewsWeatherRefresher(LocalCache(), client=None, geocodes=geocodes)
+    release = threading.Event()
+    runs = []
+    refresher._run = lambda: (runs.append(1), release.wait(5))
+    # Every request thread calls start() at once, like the first requests of a gthread worker
+    barrier = threading.Barrier(8)
+    callers = [threading.Thread(target=lambda: (barrier.wait(), refresher.start())) for _ in range(8)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    release.set()
+    refresher._thread.join()
+    assert runs == [1]
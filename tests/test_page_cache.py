@@ -0,0 +1,108 @@
+import pytest
+from flask import Flask, url_for
+from flask_login import LoginManager
+
+from cache import LocalCache
+from page_cache import PageCache
+
+
+@pytest.fixture
+def page_cache():
+    return PageCache(LocalCache())
+
+
+@pytest.fixture
+def app(page_cache):
+    app = Flask(__name__)
+    app.secret_key = "test"
+    LoginManager(app).user_loader(lambda user_id: None)
+    app.renders = 0
+    # Called in the middle of a render, like a write committing on another thread
+    app.during_render = None
+
+    @app.route("/post/<int:post_id>")
+    @page_cache.cached()
+    def post(post_id):
+        app.renders += 1
+        if app.during_render:
+            app.during_render()
+        page_cache.tag(f"post:{post_id}", "posts")
+        return f"post {post_id} render {app.renders}"
+
+    @app.route("/feed")
+    @page_cache.cached(shared=True)
+    def feed():
+        return url_for("post", post_id=1, _external=True)
+
+    return app
+
+
+def test_pages_are_served_from_cache_until_a_tag_is_invalidated(app, page_cache):
+    client = app.test_client()
+    assert client.get("/post/1").headers["X-Cache"] == "MISS"
+    response = client.get("/post/1")
+    assert response.headers["X-Cache"] == "HIT"
+    assert response.get_data(as_text=True) == "post 1 render 1"
+
+    page_cache.invalidate("post:2")
+    assert client.get("/post/1").headers["X-Cache"] == "HIT"
+
+    page_cache.invalidate("post:1")
+    response = client.get("/post/1")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_data(as_text=True) == "post 1 render 2"
+    assert client.get("/post/1").headers["X-Cache"] == "HIT"
+
+
+def test_shared_tags_drop_every_page_carrying_them(app, page_cache):
+    client = app.test_client()
+    client.get("/post/1")
+    client.get("/post/2")
+    page_cache.invalidate("posts")
+    assert client.get("/post/1").headers["X-Cache"] == "MISS"
+    assert client.get("/post/2").headers["X-Cache"] == "MISS"
+
+
+def test_invalidation_during_a_render_keeps_that_render_out_of_the_cache(app, page_cache):
+    client = app.test_client()
+    client.get("/post/1")
+    page_cache.invalidate("post:1")
+
+    # The write lands after this render read the post but before the page is stored
+    app.during_render = lambda: page_cache.invalidate("post:1")
+    assert client.get("/post/1").get_data(as_text=True) == "post 1 render 2"
+    app.during_render = None
+
+    response = client.get("/post/1")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_data(as_text=True) == "post 1 render 3"
+    assert client.get("/post/1").headers["X-Cache"] == "HIT"
+
+
+def test_absolute_urls_are_cached_per_scheme_and_host(app):
+    client = app.test_client()
+    assert client.get("/feed", base_url="http://evil.example").get_data(as_text=True) == "http://evil.example/post/1"
+    response = client.get("/feed", base_url="https://blog.example")
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.get_data(as_text=True) == "https://blog.example/post/1"
+    assert client.get("/feed", base_url="https://blog.example").headers["X-Cache"] == "HIT"
+
+
+def test_every_app_gets_its_own_cache_from_its_config():
+    page_cache = PageCache()
+    apps = []
+    for ttl in (60, 120):
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.config["PAGE_CACHE_SECONDS"] = ttl
+        LoginManager(app).user_loader(lambda user_id: None)
+        page_cache.init_app(app)
+        app.add_url_rule("/", "index", page_cache.cached()(lambda: "index"))
+        apps.append(app)
+
+    assert apps[0].test_client().get("/").headers["X-Cache"] == "MISS"
+    assert apps[0].test_client().get("/").headers["X-Cache"] == "HIT"
+    # Nothing shared with the first app
+    assert apps[1].test_client().get("/").headers["X-Cache"] == "MISS"
+    with apps[1].app_context():
+        assert page_cache.default_ttl == 120
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from passwords import HashingOverloaded, PasswordHasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(method="pbkdf2:sha256:1000", max_workers=1, max_queue=0, timeout=5)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_hash_and_verify(hasher):
+    stored = hasher.hash("secret-password")
+    assert hasher.verify(stored, "secret-password")
+    assert not hasher.verify(stored, "wrong-password")
+    assert not hasher.needs_rehash(stored)
+
+
+def test_full_pool_fails_fast(hasher):
+    stored = hasher.hash("secret-password")
+    busy = threading.Thread(target=hasher._run, args=(time.sleep, 1))
+    busy.start()
+    try:
+        # Wait until the sleeper holds the only slot
+        deadline = time.monotonic() + 5
+        while hasher._slots._value and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        started = time.monotonic()
+        with pytest.raises(HashingOverloaded):
+            hasher.verify(stored, "secret-password")
+        assert time.monotonic() - started < 0.1
+    finally:
+        busy.join()
+    assert hasher.verify(stored, "secret-password")
+
+
+def test_shipped_defaults_leave_threads_free():
+    import server
+    assert server.PASSWORD_HASH_WORKERS + server.PASSWORD_HASH_QUEUE < server.WEB_THREADS
+
+
+def test_init_app_hashes_with_the_app_config():
+    passwords = PasswordHasher()
+    app = Flask(__name__)
+    app.config.update(PASSWORD_HASH_METHOD="pbkdf2:sha256:1000", PASSWORD_HASH_WORKERS=1)
+    passwords.init_app(app)
+    try:
+        with app.app_context():
+            stored = passwords.hash("secret-password")
+            assert stored.startswith("pbkdf2:sha256:1000$")
+            assert passwords.verify(stored, "secret-password")
+    finally:
+        app.extensions["passwords"].shutdown()
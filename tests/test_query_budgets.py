@@ -0,0 +1,144 @@
+"""Every page with a @query_budget, rendered against seeded data with TESTING on - a route that
+goes over its budget raises QueryBudgetExceeded and fails here."""
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, exc, text
+
+import search
+import server
+from benchmarks.seed import seed
+from database import db
+from instrumentation import Instrumentation
+from query_budget import QueryBudgetExceeded, query_budget, report_query_count
+
+# In seeded titles, bodies and comments alike, so search ranks and snippets both tables
+SEARCH_WORD = "coffee"
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("query-budgets")
+    app = server.create_app({
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp / 'posts.db'}",
+        "RATE_LIMIT_ENABLED": False,
+        "IMAGE_CACHE_DIR": str(tmp / "thumbnails"),
+        "IMAGE_FETCH": lambda url: b"",
+    })
+    # No news/weather refresher or mail sender threads, pages render without them
+    for name in ("refresher", "mail_worker"):
+        app.extensions[name].start = lambda: None
+    with app.app_context():
+        db.create_all()
+        seed(users=5, posts=30, comments_per_post=3)
+        with db.engine.begin() as conn:
+            search.rebuild(app.extensions["search_index"], conn)
+    return app
+
+
+@pytest.fixture(autouse=True)
+def cold_caches(app):
+    # A page cache hit would skip the budget check
+    for name in ("user_cache", "page_cache"):
+        app.extensions[name].clear()
+    app.extensions["refresher"].cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def logged_in(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = "1"
+    # Users are loaded once per USER_CACHE_SECONDS, not per page - budget the steady state
+    client.get("/about")
+    return client
+
+
+# The seed numbers posts 1-30 in order and gives each three comments, post 7 has comments 19-21
+PAGES = [
+    "/",
+    "/?before=21",
+    "/?after=10",
+    "/posts.json",
+    "/posts.json?before=21",
+    "/posts/7",
+    "/posts/7/comments",
+    "/posts/7/comments?before=21",
+    "/posts/7/comments?before=21&format=json",
+    "/profile/2",
+    "/feed.xml",
+    "/feed.json",
+    "/profile/2/feed.xml",
+    "/profile/2/feed.json",
+    f"/search?q={SEARCH_WORD}",
+]
+
+
+@pytest.mark.parametrize("path", PAGES)
+def test_anonymous_pages_stay_within_budget(client, path):
+    assert client.get(path).status_code == 200
+
+
+@pytest.mark.parametrize("path", PAGES)
+def test_logged_in_pages_stay_within_budget(logged_in, path):
+    assert logged_in.get(path).status_code == 200
+
+
+@pytest.mark.parametrize("path, shows, hides", [
+    ("/?before=21", "/posts/20", "/posts/21"),
+    ("/?after=10", "/posts/11", "/posts/10"),
+])
+def test_later_pages_are_real_pages(client, path, shows, hides):
+    # A parameter the route ignores would render page one and pass the budget tests for nothing
+    body = client.get(path).get_data(as_text=True)
+    assert f'{shows}"' in body
+    assert f'{hides}"' not in body
+
+
+def test_going_over_budget_fails_the_request():
+    # Guards the check itself - a budget that never fires would pass every test above
+    engine = create_engine("sqlite://")
+    app = Flask(__name__)
+    app.testing = True
+
+    @app.route("/two-queries")
+    @query_budget(1)
+    def two_queries():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+        return "done"
+
+    with pytest.raises(QueryBudgetExceeded, match="ran 2 queries, budget is 1"):
+        app.test_client().get("/two-queries")
+
+
+def test_query_count_header_and_server_timing_agree():
+    engine = create_engine("sqlite://")
+    app = Flask(__name__)
+    app.config.update(QUERY_COUNT_HEADER=True, REQUEST_LOG=False, METRICS_ENDPOINT=False)
+    Instrumentation(app)
+    app.after_request(report_query_count)
+
+    @app.route("/failing-query")
+    def failing_query():
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            with pytest.raises(exc.OperationalError):
+                conn.execute(text("SELECT * FROM missing"))
+        return "done"
+
+    response = app.test_client().get("/failing-query")
+    assert response.headers["X-Query-Count"] == "2"
+    assert 'desc="2 queries"' in response.headers["Server-Timing"]
+
+
+def test_older_comments_are_a_real_page(client):
+    comments = client.get("/posts/7/comments?before=21&format=json").get_json()["comments"]
+    assert [comment["id"] for comment in comments] == [20, 19]
@@ -0,0 +1,123 @@
+import threading
+import time
+
+from flask import Flask
+from flask_login import LoginManager
+
+from rate_limit import MemoryLimits, RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_app(limiter, rule="2/minute", concurrency=8):
+    app = Flask(__name__)
+    app.config.update(RATE_LIMITS={"ping": rule}, EXPENSIVE_CONCURRENCY=concurrency)
+    LoginManager(app).user_loader(lambda user_id: None)
+
+    @app.route("/ping", methods=["GET", "POST"])
+    @limiter.limit("ping", methods=("POST",), expensive=True)
+    def ping():
+        return "pong"
+
+    return app
+
+
+def test_bucket_rejects_with_retry_after_until_it_refills():
+    clock = FakeClock()
+    client = make_app(RateLimiter(MemoryLimits(clock=clock))).test_client()
+
+    assert client.post("/ping").status_code == 200
+    assert client.post("/ping").status_code == 200
+    response = client.post("/ping")
+    assert response.status_code == 429
+    # 2/minute refills one token every 30 seconds
+    assert response.headers["Retry-After"] == "30"
+
+    clock.now += 29
+    response = client.post("/ping")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+    clock.now += 1
+    assert client.post("/ping").status_code == 200
+    assert client.post("/ping").status_code == 429
+
+
+def test_buckets_are_per_client_and_per_method():
+    clock = FakeClock()
+    client = make_app(RateLimiter(MemoryLimits(clock=clock)), rule="1/hour").test_client()
+
+    assert client.post("/ping", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 200
+    assert client.post("/ping", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 429
+    assert client.post("/ping", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code == 200
+    # Only POSTs are limited
+    assert client.get("/ping", environ_base={"REMOTE_ADDR": "10.0.0.1"}).status_code == 200
+
+
+def test_concurrency_cap_sheds_requests_and_releases_slots():
+    limits = MemoryLimits(clock=FakeClock())
+    app = make_app(RateLimiter(limits), rule="", concurrency=1)
+    client = app.test_client()
+
+    slot = limits.acquire("expensive", 1)
+    response = client.post("/ping")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+    limits.release("expensive", slot)
+    assert client.post("/ping").status_code == 200
+    # The view's slot was handed back
+    assert limits.acquire("expensive", 1) is not None
+
+
+def test_disabled_limits_let_everything_through():
+    clock = FakeClock()
+    app = make_app(RateLimiter(MemoryLimits(clock=clock)), rule="1/hour")
+    app.config["RATE_LIMIT_ENABLED"] = False
+    client = app.test_client()
+
+    assert [client.post("/ping").status_code for _ in range(3)] == [200, 200, 200]
+
+
+def test_concurrency_cap_triggers_at_the_shipped_defaults():
+    import server
+    # Without Redis the cap is per process - it has to be reachable with the worker's threads
+    assert server.EXPENSIVE_CONCURRENCY < server.WEB_THREADS
+
+    release = threading.Event()
+    app = Flask(__name__)
+    app.config.update(RATE_LIMITS={}, EXPENSIVE_CONCURRENCY=server.EXPENSIVE_CONCURRENCY)
+    LoginManager(app).user_loader(lambda user_id: None)
+    limiter = RateLimiter(MemoryLimits(clock=FakeClock()))
+
+    @app.route("/slow")
+    @limiter.limit("slow", expensive=True)
+    def slow():
+        release.wait(5)
+        return "done"
+
+    statuses = []
+    threads = [
+        threading.Thread(target=lambda: statuses.append(app.test_client().get("/slow").status_code))
+        for _ in range(server.EXPENSIVE_CONCURRENCY)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while limiter.backend._in_flight.get("expensive", 0) < server.EXPENSIVE_CONCURRENCY:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        # One request over the cap is shed while the others still run
+        assert app.test_client().get("/slow").status_code == 429
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    assert statuses == [200] * server.EXPENSIVE_CONCURRENCY
@@ -0,0 +1,70 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from outbound import DeadlineExceeded, HttpClient
+from thumbnails import HttpImageFetcher, ThumbnailError, check_address
+
+
+class Origin(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/redirect-home":
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/image")
+            self.end_headers()
+        elif self.path == "/drip":
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            for _ in range(100):
+                self.wfile.write(b"x")
+                self.wfile.flush()
+                time.sleep(0.05)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write(b"image")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+class PublicFirstHop(HttpImageFetcher):
+    # Pretends the first URL is public, so what's under test is the redirect to localhost
+    def check_url(self, url):
+        if getattr(self, "checked", False):
+            super().check_url(url)
+        self.checked = True
+
+
+def test_redirects_to_private_addresses_are_refused(origin):
+    with pytest.raises(ThumbnailError):
+        PublicFirstHop(HttpClient())(f"{origin}/redirect-home")
+
+
+def test_connections_reaching_private_addresses_are_refused(origin):
+    fetcher = HttpImageFetcher(HttpClient(check_address=check_address))
+    fetcher.check_url = lambda url: None
+    with pytest.raises(ThumbnailError):
+        fetcher(f"{origin}/image")
+
+
+def test_slow_origins_run_into_the_deadline(origin):
+    fetcher = HttpImageFetcher(HttpClient(), allow_private=True, deadline_seconds=0.5)
+    assert fetcher(f"{origin}/redirect-home") == b"image"
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        fetcher(f"{origin}/drip")
+    assert time.monotonic() - started < 2
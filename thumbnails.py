@@ -0,0 +1,217 @@
+"""Thumbnails of remote post images and avatars, served from /img.
+
+Templates link to signed /img/<size>?url=... URLs (thumbnail() in templates), so the proxy only
+fetches images that appear on our own pages. Each remote image is fetched once, scaled to a fixed
+size with Pillow and written to a disk cache addressed by the SHA-256 of size and source URL.
+The cache is bounded in bytes and evicts the least recently served files first. Fetching goes
+through an injectable callable (url -> bytes) so tests and benchmarks never touch the network.
+"""
+from __future__ import annotations
+import hashlib
+import hmac
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from cache import LocalCache
+from outbound import Deadline
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40_000_000
+# Whole fetch including redirects - it holds a request thread the entire time
+FETCH_SECONDS = 5
+# Failed sources are not retried for this long - the route redirects to the original instead
+FAILURE_SECONDS = 300
+FORMAT = "WEBP"
+MIMETYPE = "image/webp"
+
+
+@dataclass(frozen=True)
+class Size:
+    width: int
+    height: int
+    # Crop to exactly width x height, otherwise fit inside it keeping the aspect ratio
+    crop: bool = False
+
+
+SIZES = {
+    "avatar": Size(40, 40, crop=True),
+    "profile": Size(400, 400, crop=True),
+    "card": Size(400, 400),
+    "wide": Size(1200, 1200),
+}
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+def check_address(address: str):
+    # Post authors pick img_url - don't let it point the server at itself or the LAN
+    ip = ipaddress.ip_address(address)
+    if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast:
+        raise ThumbnailError(f"Refusing to fetch from private address {address}")
+
+
+class HttpImageFetcher:
+    """Default fetcher - a bounded GET through outbound.HttpClient, refusing private addresses.
+
+    Every redirect hop is checked before it is requested. Build the client with
+    check_address=check_address as well so the address a connection actually reaches is checked
+    too, otherwise DNS can answer differently for the request than it did for the check.
+    """
+
+    def __init__(self, client, max_bytes: int = MAX_SOURCE_BYTES, allow_private: bool = False,
+                 deadline_seconds: float = FETCH_SECONDS):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.allow_private = allow_private
+        self.deadline_seconds = deadline_seconds
+
+    def check_url(self, url: str):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ThumbnailError(f"Not an http(s) URL: {url}")
+        if not self.allow_private:
+            for *_, address in socket.getaddrinfo(parts.hostname, None):
+                check_address(address[0])
+
+    def __call__(self, url: str) -> bytes:
+        return self.client.get_bytes(
+            url, self.max_bytes, deadline=Deadline(self.deadline_seconds), check_url=self.check_url
+        )
+
+
+def render(data: bytes, size: Size) -> bytes:
+    # Pillow is only needed once an image is requested, keep it off the import path
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(data)) as image:
+        if image.width * image.height > MAX_SOURCE_PIXELS:
+            raise ThumbnailError(f"Image too large: {image.width}x{image.height}")
+        # JPEGs decode straight to a smaller scale, much cheaper than a full decode
+        image.draft("RGB", (size.width * 2, size.height * 2))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.mode in ("LA", "PA", "P") else "RGB")
+        if size.crop:
+            image = ImageOps.fit(image, (size.width, size.height), Image.LANCZOS)
+        else:
+            image.thumbnail((size.width, size.height), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, FORMAT, quality=80, method=4)
+        return output.getvalue()
+
+
+class DiskCache:
+    """Files under directory/ab/<key>, trimmed back to 90% of max_bytes once it is exceeded.
+
+    Serving a file sets its atime, eviction removes the oldest atimes first. The size is only
+    estimated between scans, so several gunicorn workers can share one directory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._estimate = None
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> str | None:
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            # Mark as recently used - mtime stays, it is the Last-Modified of the response
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._estimate is None:
+                self._estimate = self.total_bytes()
+            else:
+                self._estimate += len(data)
+            if self._estimate > self.max_bytes:
+                self._estimate = self.evict(int(self.max_bytes * 0.9))
+        return path
+
+    def _files(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    if entry.is_file() and not entry.name.startswith(".tmp-"):
+                        yield entry
+
+    def total_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in self._files())
+
+    def evict(self, target_bytes: int) -> int:
+        """Delete least recently used files until at most target_bytes remain, returns the new total."""
+        entries = sorted(((entry.stat(), entry.path) for entry in self._files()), key=lambda item: item[0].st_atime)
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+        return total
+
+
+class ImageProxy:
+    def __init__(self, cache: DiskCache, fetch, secret: str):
+        self.cache = cache
+        self.fetch = fetch
+        self.secret = (secret or "").encode()
+        self.failures = LocalCache(max_entries=1024)
+        # Striped locks so one image is only fetched once per process when a page asks many times
+        self._locks = [threading.Lock() for _ in range(32)]
+
+    @staticmethod
+    def key(size: str, url: str) -> str:
+        return hashlib.sha256(f"{size}\n{url}".encode()).hexdigest()
+
+    def sign(self, size: str, url: str) -> str:
+        return hmac.new(self.secret, f"{size}\n{url}".encode(), hashlib.sha256).hexdigest()[:32]
+
+    def verify(self, size: str, url: str, signature: str) -> bool:
+        return size in SIZES and hmac.compare_digest(self.sign(size, url), signature or "")
+
+    def thumbnail(self, size: str, url: str) -> tuple[str, str]:
+        """Path of the cached thumbnail and its key, fetching and rendering it on a miss."""
+        key = self.key(size, url)
+        path = self.cache.get(key)
+        if path is not None:
+            return path, key
+        if self.failures.get(key):
+            raise ThumbnailError(f"{url} failed recently")
+
+        with self._locks[int(key[:8], 16) % len(self._locks)]:
+            path = self.cache.get(key)
+            if path is not None:
+                return path, key
+            try:
+                data = render(self.fetch(url), SIZES[size])
+            except Exception as error:
+                self.failures.set(key, True, ttl=FAILURE_SECONDS)
+                raise ThumbnailError(f"Can't make a thumbnail of {url}: {error}") from error
+            return self.cache.put(key, data), key
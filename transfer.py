@@ -0,0 +1,139 @@
+"""Streaming export and import of users, posts and comments.
+
+The archive is gzipped JSON lines: a header, then for every table a line naming it and its
+columns followed by one JSON array per row. Export reads with yield_per (a server-side cursor on
+Postgres) and import inserts in executemany batches, so memory stays at about one batch either
+way. Used by `flask export-blog` / `flask import-blog` to move between SQLite and Postgres.
+"""
+from __future__ import annotations
+import gzip
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, func, insert, select, text
+
+from database import User, BlogPosts, Comment
+import content
+import counters
+import search
+
+FORMAT = "bloggin-export"
+VERSION = 1
+BATCH_SIZE = 1000
+# Parents first so foreign keys hold while importing
+TABLES = [User.__table__, BlogPosts.__table__, Comment.__table__]
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't export {type(value).__name__}")
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, default=_encode, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+
+def export_archive(conn, path: str, progress=None) -> dict:
+    """Write every row to a gzipped JSON-lines archive, returns the row count per table."""
+    counts = {}
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as file:
+        file.write(_dumps({"format": FORMAT, "version": VERSION, "exported_at": datetime.now()}))
+        for table in TABLES:
+            columns = [column.name for column in table.columns]
+            file.write(_dumps({"table": table.name, "columns": columns}))
+            result = conn.execution_options(yield_per=BATCH_SIZE).execute(
+                select(*table.columns).order_by(table.c.id)
+            )
+            count = 0
+            for rows in result.partitions():
+                file.writelines(_dumps(list(row)) for row in rows)
+                count += len(rows)
+                if progress:
+                    progress(table.name, count)
+            counts[table.name] = count
+    return counts
+
+
+def _read_header(file):
+    header = json.loads(file.readline() or "{}")
+    if header.get("format") != FORMAT:
+        raise ValueError("Not a blog export archive")
+    if header.get("version") != VERSION:
+        raise ValueError(f"Archive version {header.get('version')} is not supported (expected {VERSION})")
+
+
+def _decoders(table, columns):
+    # Positions of the columns this schema still has, with a parser for the ones JSON can't carry
+    decoders = []
+    for position, name in enumerate(columns):
+        if name not in table.c:
+            continue
+        parse = datetime.fromisoformat if isinstance(table.c[name].type, DateTime) else None
+        decoders.append((position, name, parse))
+    return decoders
+
+
+def _decode(values, decoders) -> dict:
+    row = {}
+    for position, name, parse in decoders:
+        value = values[position]
+        row[name] = parse(value) if parse is not None and value is not None else value
+    return row
+
+
+def _reset_sequences(conn):
+    # Rows came in with their ids, move Postgres sequences past them
+    if conn.dialect.name == "postgresql":
+        for table in TABLES:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table.name}), 0) + 1, false)"
+            ))
+
+
+def import_archive(conn, path: str, search_backend, progress=None) -> dict:
+    """Load an archive into empty tables, returns the row count per table.
+
+    Columns the archive doesn't have are filled in afterwards - counters are recomputed, missing
+    body_html is rendered and the search index is rebuilt.
+    """
+    tables = {table.name: table for table in TABLES}
+    for table in TABLES:
+        if conn.execute(select(func.count()).select_from(table)).scalar():
+            raise ValueError(f"Table {table.name} is not empty, import into a fresh database")
+
+    counts = {}
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        _read_header(file)
+        table = decoders = None
+        batch = []
+
+        def flush():
+            if batch:
+                conn.execute(insert(table), batch)
+                counts[table.name] += len(batch)
+                batch.clear()
+                if progress:
+                    progress(table.name, counts[table.name])
+
+        for line in file:
+            values = json.loads(line)
+            if isinstance(values, dict):
+                flush()
+                if values.get("table") not in tables:
+                    raise ValueError(f"Unknown table {values.get('table')!r} in archive")
+                table = tables[values["table"]]
+                decoders = _decoders(table, values["columns"])
+                counts[table.name] = 0
+                continue
+            batch.append(_decode(values, decoders))
+            if len(batch) >= BATCH_SIZE:
+                flush()
+        flush()
+
+    _reset_sequences(conn)
+    counters.repair(conn)
+    content.backfill(conn)
+    search.rebuild(search_backend, conn)
+    return counts
@@ -0,0 +1,98 @@
+"""Cached identities for logged-in users.
+
+Flask-Login asks for the user on every request. Instead of a users SELECT each time the fields
+templates and routes need are kept in a small TTL cache, dropped as soon as a User row is
+updated or deleted through the ORM, or explicitly with invalidate().
+"""
+from __future__ import annotations
+
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from cache import make_cache
+from database import db, User
+
+FIELDS = ("id", "username", "profile_pic", "email_hash")
+
+
+class SessionUser(UserMixin):
+    """What current_user is for a logged-in visitor - not attached to the DB session."""
+
+    def __init__(self, id, username, profile_pic=None, email_hash=None):
+        self.id = id
+        self.username = username
+        self.profile_pic = profile_pic
+        self.email_hash = email_hash
+
+
+class UserCache:
+    def __init__(self, cache=None, ttl: float = 300):
+        # Without a cache, init_app() gives every app its own, built from its config
+        self._cache = cache
+        self._ttl = ttl
+
+    def init_app(self, app):
+        app.config.setdefault("REDIS_URL", None)
+        app.config.setdefault("USER_CACHE_SECONDS", self._ttl)
+        app.config.setdefault("USER_CACHE_SIZE", 10000)
+        app.extensions["user_cache"] = make_cache(app.config["REDIS_URL"], max_entries=app.config["USER_CACHE_SIZE"])
+
+    @property
+    def cache(self):
+        if self._cache is not None:
+            return self._cache
+        # None outside an app, or in one without init_app() - nothing cached there to drop
+        return current_app.extensions.get("user_cache") if has_app_context() else None
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl if self._cache is not None else current_app.config["USER_CACHE_SECONDS"]
+
+    @staticmethod
+    def _key(user_id) -> str:
+        return f"session-user:{user_id}"
+
+    def get(self, user_id) -> SessionUser | None:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+        fields = self.cache.get(self._key(user_id))
+        if fields is None:
+            row = db.session.execute(
+                db.select(*(getattr(User, field) for field in FIELDS)).where(User.id == user_id)
+            ).first()
+            if row is None:
+                return None
+            fields = dict(zip(FIELDS, row))
+            self.cache.set(self._key(user_id), fields, ttl=self.ttl)
+        return SessionUser(**fields)
+
+    def invalidate(self, *user_ids):
+        cache = self.cache
+        if cache is not None:
+            cache.delete(*(self._key(user_id) for user_id in user_ids))
+
+    def watch(self):
+        """Drop cached users whenever a User row is changed or deleted through the ORM."""
+
+        def mark_changed(mapper, connection, target):
+            session = Session.object_session(target)
+            if session is not None:
+                session.info.setdefault("changed_users", set()).add(target.id)
+
+        def after_commit(session):
+            changed = session.info.pop("changed_users", None)
+            if changed:
+                self.invalidate(*changed)
+
+        def after_rollback(session):
+            session.info.pop("changed_users", None)
+
+        event.listen(User, "after_update", mark_changed)
+        event.listen(User, "after_delete", mark_changed)
+        event.listen(Session, "after_commit", after_commit)
+        event.listen(Session, "after_rollback", after_rollback)